@@ -9,7 +9,7 @@
 
 from enum import Enum, auto
 from dataclasses import dataclass
-from typing import Dict
+from typing import Dict, Optional
 from inspect import cleandoc
 
 import pandas as pd
@@ -40,6 +40,7 @@ class ModelArrays:
     NP: int  # Number of participants
     T: int  # Number of choice situations per participant
     is_balanced_panel: bool # Is the dataset a balanced panel?
+    RowID: Optional[npt.NDArray] = None  # Participant ID of each row of BVTT and Choice
 
 
 @dataclass
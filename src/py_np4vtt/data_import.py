@@ -127,10 +127,12 @@ def make_modelarrays(dataset_frame: pd.DataFrame, dataset_varmapping: VarsMappin
         is_balanced_panel = True
         t_int = math.floor(t)
         rows = id_uniq.size
+        row_id = id_uniq
     else:
         is_balanced_panel = False
         t_int = 1
         rows = id_all.size
+        row_id = id_all.to_numpy()
 
     npar = id_uniq.size
 
@@ -152,7 +154,8 @@ def make_modelarrays(dataset_frame: pd.DataFrame, dataset_varmapping: VarsMappin
         ID=id_uniq,
         NP=npar,
         T=t_int,
-        is_balanced_panel=is_balanced_panel
+        is_balanced_panel=is_balanced_panel,
+        RowID=row_id
     )
 
 
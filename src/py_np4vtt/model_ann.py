@@ -7,15 +7,20 @@
 #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """Modules to configure and estimate an ANN-based VTT model."""
 from dataclasses import dataclass
+from contextlib import contextmanager
 
 from typing import List, Optional
 
 from numpy import ndarray
 
 from py_np4vtt.data_format import ModelArrays
+from py_np4vtt.utils import _SharedArrays, _attach_shared
 
 import numpy as np
+import pandas as pd
+import os
 import time
+from concurrent.futures import ProcessPoolExecutor
 
 from sklearn.neural_network import MLPClassifier
 from sklearn.model_selection import train_test_split
@@ -44,6 +49,32 @@ class ConfigANN:
 
     seed : Optional[int]
         Random seed for the shuffling and estimation process.
+    chunkSize : int
+        Number of respondents whose choices are simulated at once to 
+        recover their VTT. The peak memory of the simulation grows 
+        linearly with `chunkSize` and not with the sample size (about 
+        2 MB per respondent with 10 choice tasks). Default is 100
+    n_jobs : int
+        Number of worker processes that run the training repeats. The 
+        training data are shared with the workers through shared memory, 
+        and each worker uses one BLAS thread. `-1` uses all available 
+        cores. Each repeat is seeded with its own child of `seed`, so the 
+        results do not depend on the number of workers. Default is 1
+    vttSearch : str
+        Search of the VTT of each respondent on the simulated choice 
+        probabilities. `'grid'` (default) evaluates the ANN on a grid of 
+        201 VTT points. `'bisect'` brackets the point where the choice 
+        probability crosses 0.5 and bisects it, with about 
+        `log2(1.5*max(BVTT)/vttTol)` evaluations of the ANN.
+    vttTol : float
+        Tolerance on the recovered VTT with `vttSearch='bisect'`, in the 
+        units of the BVTT. Default is 0.01
+    fastPredict : bool
+        If True, the trained ANN is evaluated with a NumPy forward pass in 
+        single precision, with the scaling of the inputs folded into the 
+        first layer, instead of `MLPClassifier.predict_proba`. The choice 
+        probabilities match those of scikit-learn up to about 1e-6. 
+        Default is False
     """
     hiddenLayerNodes: List[int]
 
@@ -52,6 +83,12 @@ class ConfigANN:
 
     seed: Optional[int]
 
+    chunkSize: int = 100
+    n_jobs: int = 1
+    vttSearch: str = 'grid'
+    vttTol: float = 0.01
+    fastPredict: bool = False
+
     def validate(self):
         # Create errormessage list
         errorList = []
@@ -62,6 +99,18 @@ class ConfigANN:
         if not self.shufflesPerRepeat > 0:
             errorList.append('Number of shuffles per repeats must be positive.')
 
+        if not self.chunkSize > 0:
+            errorList.append('Chunk size must be positive.')
+
+        if not (self.n_jobs > 0 or self.n_jobs == -1):
+            errorList.append('No. of jobs must be greater than zero, or -1 to use all cores.')
+
+        if self.vttSearch not in ('grid', 'bisect'):
+            errorList.append("VTT search must be either 'grid' or 'bisect'.")
+
+        if not self.vttTol > 0:
+            errorList.append('VTT tolerance must be greater than zero.')
+
         # Whoever calls this validator knows that empty errorList means validator success
         return errorList
 
@@ -97,6 +146,10 @@ class ModelANN:
     -------
     run():
         Estimates the ANN-based model.
+    trainRepeat(seed, vtt_grid):
+        Trains the ANN once and recovers the VTT of each respondent.
+    searchTopology(candidates, n_jobs):
+        Compares ANN topologies on the prepared data.
     
     References
     ----------
@@ -111,22 +164,14 @@ class ModelANN:
         # Check if data is a balanced panel. Otherwise raise an error
         assert arrays.is_balanced_panel, "Data is not a balanced panel. ModelANN is only compatible with balanced panel data"
 
-        # Initialise arrays for randomisation
-        shuffle_index = np.zeros((self.cfg.shufflesPerRepeat,self.arrays.T+1))
-        full_data_array = np.zeros((self.arrays.NP,self.cfg.shufflesPerRepeat*(self.arrays.T+1),2))
-
-        # Randomise data
-        for n in range(self.arrays.NP):
-            for m in range(self.cfg.shufflesPerRepeat):
-                rnd11 = np.arange(self.arrays.T)
-                np.random.shuffle(rnd11)
-                shuffle_index[m,:] = np.hstack((rnd11,rnd11[np.random.randint(1,self.arrays.T-1)]))
-            
-            full_data_array[n,:,0] = self.arrays.Choice[n,shuffle_index.astype(int).flatten()]
-            full_data_array[n,:,1] = self.arrays.BVTT[n,shuffle_index.astype(int).flatten()]
-
-        # Create input and output arrays for ANN
-        full_data_array = np.hstack((np.reshape(full_data_array[:,:,0].T,(self.arrays.T+1,self.cfg.shufflesPerRepeat*self.arrays.NP),order='F').T,np.reshape(full_data_array[:,:,1].T,(self.arrays.T+1,self.cfg.shufflesPerRepeat*self.arrays.NP),order='F').T))
+        # Randomise data: each respondent's choice tasks are shuffled `shufflesPerRepeat` times, 
+        # and one of them is repeated at the end of each shuffle
+        rng = np.random.default_rng(self.cfg.seed)
+        shuffle_index = ModelANN.shuffleIndex(rng,self.arrays.NP,self.cfg.shufflesPerRepeat,self.arrays.T)
+        resp_index = np.arange(self.arrays.NP)[:,np.newaxis,np.newaxis]
+
+        # Create input and output arrays for ANN, with one row per respondent and shuffle
+        full_data_array = np.hstack((np.reshape(self.arrays.Choice[resp_index,shuffle_index],(-1,self.arrays.T+1)),np.reshape(self.arrays.BVTT[resp_index,shuffle_index],(-1,self.arrays.T+1))))
         t = full_data_array[:,0]
         x = full_data_array[:,1:]
 
@@ -168,65 +213,30 @@ class ModelANN:
         """
         ll_list = []
         rho_sq = []
-        y_predict = []
         VTT_mid_list = []
 
-        # Start optimisation loop
-        t0 = time.time()
-        for r in range(self.cfg.trainingRepeats):
-            
-            if verbose:
-                print('Rep ' + str(r+1) + ': ',end='',flush=True)
-
-            clf = MLPClassifier(
-                hidden_layer_sizes=self.cfg.hiddenLayerNodes,
-                activation='tanh',
-                tol=1e-4,
-                alpha=0.,
-                n_iter_no_change=6,
-                max_iter=1000,
-                early_stopping=True,
-                validation_fraction=0.1275,
-                verbose=False,random_state=self.cfg.seed).fit(self.X_train,self.y_train)
-
-            # Predict in test sample
-            y_predict_train = clf.predict_proba(self.X_train)
-            y_predict_test = clf.predict_proba(self.X_test)
-
-            y_predict.append(y_predict_test)
-
-            # Get train and test loss
-            train_loss = log_loss(self.y_train,y_predict_train)
-            test_loss = log_loss(self.y_test,y_predict_test)
-
-            # Compute log-likelihood and Rho-sq in full sample
-            ll = -len(self.y_train)*train_loss - len(self.y_test)*test_loss
-            r2 = 1 - (ll/(np.log(0.5)*len(self.y_full)))
-            ll_list.append(ll)
-            rho_sq.append(r2)
-
-            if verbose:
-                print('CE (train): ' + str(round(train_loss,4)) + ' / CE (test): ' + str(round(test_loss,4)) + ' / LL: ' + str(round(ll,2)) + ' / Rho-sq: ' + str(round(r2,2)))
-            
-            # Simulate N-choice of each individual using the ANN
-            vtt_grid = np.tile(np.linspace(0,1.5*self.X_full.max(),201),(self.arrays.Accepts.shape[0],1))
-            y_pred_N = ModelANN.simulateNChoice(self,clf,self.arrays.Choice,vtt_grid,self.arrays.BVTT,20)
-
-            # Recover individual VTTs, using simulation of choice probs
-            VTT_mid = np.zeros(self.arrays.NP)
-            no_vtt = 0
-            for n in range(self.arrays.NP):
-                if np.max(y_pred_N[n,:]) > 0.5 and np.min(y_pred_N[n,:])<0.5:
-                    delta_x = vtt_grid[n,np.where((y_pred_N[n,:]-0.5)>=0)[0][-1]] - vtt_grid[n,np.where((y_pred_N[n,:]-0.5)<=0)[0][0]]
-                    delta_y = y_pred_N[n,np.where((y_pred_N[n,:]-0.5)>=0)[0][-1]] - y_pred_N[n,np.where((y_pred_N[n,:]-0.5)<=0)[0][0]]
-                    VTT_mid[n] = vtt_grid[n,np.where((y_pred_N[n,:]-0.5)>=0)[0][-1]] - (y_pred_N[n,np.where((y_pred_N[n,:]-0.5)>=0)[0][-1]]-0.5)/(delta_y/delta_x)
-                else:
-                    no_vtt = no_vtt+1
+        # Independent seeds for the training and simulation of each repeat
+        seeds = np.random.SeedSequence(self.cfg.seed).spawn(self.cfg.trainingRepeats)
 
-            VTT_mid_list.append(VTT_mid)
+        # VTT grid to simulate the choices of each respondent
+        vtt_grid = np.linspace(0,1.5*self.X_full.max(),201)
 
-            if verbose:
-                print('(No VTT recovered for ' + str(no_vtt) + ' respondents)')
+        # Start optimisation loop
+        t0 = time.time()
+        n_jobs = os.cpu_count() if self.cfg.n_jobs == -1 else self.cfg.n_jobs
+        n_jobs = min(n_jobs, self.cfg.trainingRepeats)
+        if n_jobs > 1:
+            with self._workerPool(n_jobs) as executor:
+                results = executor.map(_trainRepeatWorker, seeds, [vtt_grid]*len(seeds))
+                for r, result in enumerate(results):
+                    if verbose:
+                        print('Rep ' + str(r+1) + ': ',end='',flush=True)
+                    ModelANN._collectRepeat(result, ll_list, rho_sq, VTT_mid_list, verbose)
+        else:
+            for r in range(self.cfg.trainingRepeats):
+                if verbose:
+                    print('Rep ' + str(r+1) + ': ',end='',flush=True)
+                ModelANN._collectRepeat(self.trainRepeat(seeds[r], vtt_grid), ll_list, rho_sq, VTT_mid_list, verbose)
 
         # Compute elapsed time
         t1 = time.time()
@@ -239,22 +249,454 @@ class ModelANN:
 
         return ll_list, r2_list, vtt_list, est_time, avg_time
 
+    def trainRepeat(self, seed, vtt_grid):
+        """Trains the ANN once and recovers the VTT of each respondent.
+
+        Parameters
+        ----------
+        seed : numpy.random.SeedSequence
+            Seed of the repeat. It seeds the initial weights of the ANN and 
+            the random orders of the choices in the simulation.
+        vtt_grid : numpy.ndarray
+            VTT grid to simulate the choices of each respondent.
+
+        Returns
+        -------
+        ll : float
+            The log-likelihood in the full sample.
+        r2 : float
+            The Rho-squared in the full sample.
+        VTT_mid : numpy.ndarray
+            The recovered VTT of each respondent (zero if not recovered).
+        no_vtt : int
+            Number of respondents whose VTT is not recovered.
+        train_loss : float
+            Cross-entropy in the train sample.
+        test_loss : float
+            Cross-entropy in the test sample.
+        """
+        seed_ann, seed_sim = ModelANN._repeatSeeds(seed)
+
+        clf = self.trainANN(self.cfg.hiddenLayerNodes, seed_ann)
+
+        # Use the NumPy forward pass on the scaled train and test inputs, and on the unscaled simulated inputs
+        if self.cfg.fastPredict:
+            predictor = _MLPPredictor(clf)
+            clf = _MLPPredictor(clf,self.scaler)
+        else:
+            predictor = clf
+
+        ll, r2, train_loss, test_loss = self.logLikelihood(predictor)
+
+        if self.cfg.vttSearch == 'bisect':
+            # Bisect the VTT of each individual on the simulated choice probs
+            VTT_mid, unrecovered = ModelANN.bisectVTT(self,clf,self.arrays.Choice,(vtt_grid[0],vtt_grid[-1]),self.arrays.BVTT,20,tol=self.cfg.vttTol,rng=np.random.default_rng(seed_sim),chunkSize=self.cfg.chunkSize)
+        else:
+            # Simulate N-choice of each individual using the ANN
+            vtt_grid = np.tile(vtt_grid,(self.arrays.NP,1))
+            y_pred_N = ModelANN.simulateNChoice(self,clf,self.arrays.Choice,vtt_grid,self.arrays.BVTT,20,rng=np.random.default_rng(seed_sim),chunkSize=self.cfg.chunkSize)
+
+            # Recover individual VTTs, using simulation of choice probs
+            VTT_mid, unrecovered = ModelANN.recoverVTT(y_pred_N,vtt_grid)
+        no_vtt = int(np.sum(unrecovered))
+
+        return ll, r2, VTT_mid, no_vtt, train_loss, test_loss
+
+    def trainANN(self, hiddenLayerNodes, seed):
+        """Trains an ANN with the given topology on the train sample.
+
+        Parameters
+        ----------
+        hiddenLayerNodes : List[int]
+            Topology of the ANN.
+        seed : numpy.random.SeedSequence
+            Seed of the initial weights of the ANN.
+
+        Returns
+        -------
+        sklearn.neural_network.MLPClassifier
+            The trained ANN.
+        """
+        return MLPClassifier(
+            hidden_layer_sizes=hiddenLayerNodes,
+            activation='tanh',
+            tol=1e-4,
+            alpha=0.,
+            n_iter_no_change=6,
+            max_iter=1000,
+            early_stopping=True,
+            validation_fraction=0.1275,
+            verbose=False,random_state=int(seed.generate_state(1)[0])).fit(self.X_train,self.y_train)
+
+    def logLikelihood(self, clf):
+        """Log-likelihood and Rho-squared of a trained ANN in the full sample.
+
+        Returns
+        -------
+        ll : float
+            The log-likelihood in the full sample.
+        r2 : float
+            The Rho-squared in the full sample.
+        train_loss : float
+            Cross-entropy in the train sample.
+        test_loss : float
+            Cross-entropy in the test sample.
+        """
+        # Predict in test sample
+        y_predict_train = ModelANN._predictProba(clf,self.X_train)
+        y_predict_test = ModelANN._predictProba(clf,self.X_test)
+
+        # Get train and test loss
+        train_loss = log_loss(self.y_train,y_predict_train)
+        test_loss = log_loss(self.y_test,y_predict_test)
+
+        # Compute log-likelihood and Rho-sq in full sample
+        ll = -len(self.y_train)*train_loss - len(self.y_test)*test_loss
+        r2 = 1 - (ll/(np.log(0.5)*(len(self.y_train)+len(self.y_test))))
+
+        return ll, r2, train_loss, test_loss
+
+    def searchTopology(self, candidates, n_jobs=1, verbose=True):
+        """Compares ANN topologies on the data prepared by this model.
+
+        Each candidate is trained once on the train sample, with the seed 
+        of the first training repeat of `run()`. The candidates can be 
+        trained in parallel worker processes, which share the train and 
+        test data through shared memory.
+
+        Parameters
+        ----------
+        candidates : List[List[int]]
+            Candidate topologies, in the format of `hiddenLayerNodes`.
+        n_jobs : int
+            Number of worker processes. `-1` uses all available cores.
+        verbose : bool
+            Print the results of each candidate.
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per candidate, ranked from the lowest cross-entropy in 
+            the test sample, with columns `hiddenLayerNodes`, `ce_test`, 
+            `ce_train`, `ll` and `rho_sq` (log-likelihood and rho-squared 
+            in the full sample, which includes the train sample and favours 
+            overfitted topologies) and `est_time` (training time in seconds).
+        """
+        candidates = [list(nodes) for nodes in candidates]
+        seed_ann, _ = ModelANN._repeatSeeds(np.random.SeedSequence(self.cfg.seed).spawn(1)[0])
+
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        n_jobs = min(n_jobs, len(candidates))
+        if n_jobs > 1:
+            with self._workerPool(n_jobs) as executor:
+                results = list(executor.map(_searchTopologyWorker, candidates, [seed_ann]*len(candidates)))
+        else:
+            results = [self._fitTopology(nodes, seed_ann) for nodes in candidates]
+
+        if verbose:
+            for nodes, (ll, r2, _, test_loss, est_time) in zip(candidates, results):
+                print('Topology ' + str(nodes) + ': CE (test): ' + str(round(test_loss,4)) + ' / LL: ' + str(round(ll,2)) + ' / Rho-sq: ' + str(round(r2,2)) + ' / Time: ' + str(round(est_time,2)) + ' s')
+
+        table = pd.DataFrame(results, columns=['ll', 'rho_sq', 'ce_train', 'ce_test', 'est_time'])
+        table.insert(0, 'hiddenLayerNodes', candidates)
+        table = table[['hiddenLayerNodes', 'ce_test', 'ce_train', 'll', 'rho_sq', 'est_time']]
+
+        return table.sort_values('ce_test', ignore_index=True)
+
+    def _fitTopology(self, hiddenLayerNodes, seed):
+        t0 = time.time()
+        clf = self.trainANN(hiddenLayerNodes, seed)
+        ll, r2, train_loss, test_loss = self.logLikelihood(clf)
+
+        return ll, r2, train_loss, test_loss, time.time() - t0
+
+    @contextmanager
+    def _workerPool(self, n_jobs):
+        # Process pool whose workers read the train and test data from shared memory
+        shared = _SharedArrays(X_train=self.X_train,X_test=self.X_test,y_train=self.y_train,y_test=self.y_test)
+        try:
+            with ProcessPoolExecutor(n_jobs, initializer=_initWorker, initargs=(shared.spec, self.cfg, self.arrays, self.scaler)) as executor:
+                yield executor
+        finally:
+            shared.close()
+
     @staticmethod
-    def simulateNChoice(self,clf,y,vtt_grid,X,R):
+    def _repeatSeeds(seed):
+        # Seeds of the initial weights of the ANN and of the simulation of a repeat
+        return [np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + (i,)) for i in range(2)]
 
-        # Create arrays for random shufflings
-        x_sim = np.zeros((y.shape[0]*vtt_grid.shape[1],2*self.arrays.T+1,R))
-        y_sim = np.zeros((y.shape[0],vtt_grid.shape[1],R))
-        
-        for n in range(y.shape[0]):
-            for r in range(R):
-                rndp = np.arange(self.arrays.T)
-                np.random.shuffle(rndp)
+    @staticmethod
+    def _collectRepeat(result, ll_list, rho_sq, VTT_mid_list, verbose):
+        ll, r2, VTT_mid, no_vtt, train_loss, test_loss = result
+        ll_list.append(ll)
+        rho_sq.append(r2)
+        VTT_mid_list.append(VTT_mid)
 
-                x_sim[(n*vtt_grid.shape[1]):((n+1)*vtt_grid.shape[1]),:,r] = np.c_[np.tile(y[n,rndp],(vtt_grid.shape[1],1)), vtt_grid[n,:].T, np.tile(X[n,rndp],(vtt_grid.shape[1],1))]
-        
-        for r in range(R):
-            y_sim[:,:,r] = np.reshape(clf.predict_proba(self.scaler.transform(x_sim[:,:,r]))[:,1],(vtt_grid.shape[1],y.shape[0]),order='F').T
-        y_median = np.median(y_sim,axis=2)
+        if verbose:
+            print('CE (train): ' + str(round(train_loss,4)) + ' / CE (test): ' + str(round(test_loss,4)) + ' / LL: ' + str(round(ll,2)) + ' / Rho-sq: ' + str(round(r2,2)))
+            print('(No VTT recovered for ' + str(no_vtt) + ' respondents)')
+
+    @staticmethod
+    def _predictProba(clf,x,scaler=None):
+        # A _MLPPredictor already includes the scaling of the inputs
+        if isinstance(clf,_MLPPredictor):
+            return clf.predict_proba(x)
+        if scaler is not None:
+            x = scaler.transform(x)
+        return clf.predict_proba(x)
+
+    @staticmethod
+    def recoverVTT(y_pred,vtt_grid):
+        """Recovers the VTT of each respondent from the simulated choice 
+        probabilities, as the point where the probability crosses 0.5.
+
+        The crossing is interpolated linearly between the last grid point 
+        with probability at or above 0.5 and the first grid point with 
+        probability at or below 0.5.
+
+        Parameters
+        ----------
+        y_pred : numpy.ndarray
+            An (NP, G) array with the simulated choice probability of each 
+            respondent at each point of the VTT grid.
+        vtt_grid : numpy.ndarray
+            The VTT grid, either of shape (G,) or (NP, G).
+
+        Returns
+        -------
+        VTT : numpy.ndarray
+            The recovered VTT of each respondent, zero if not recovered.
+        unrecovered : numpy.ndarray
+            Boolean mask of the respondents whose simulated probabilities 
+            do not cross 0.5.
+        """
+        vtt_grid = np.broadcast_to(vtt_grid,y_pred.shape)
+        resp_index = np.arange(y_pred.shape[0])
+        G = y_pred.shape[1]
+
+        # Last grid point at or above 0.5 and first grid point at or below 0.5
+        hi = G - 1 - np.argmax((y_pred >= 0.5)[:,::-1],axis=1)
+        lo = np.argmax(y_pred <= 0.5,axis=1)
+        unrecovered = ~((np.max(y_pred,axis=1) > 0.5) & (np.min(y_pred,axis=1) < 0.5))
+
+        # Linear interpolation of the crossing
+        x_hi, y_hi = vtt_grid[resp_index,hi], y_pred[resp_index,hi]
+        delta_x = x_hi - vtt_grid[resp_index,lo]
+        delta_y = y_hi - y_pred[resp_index,lo]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            VTT = np.where(unrecovered, 0., x_hi - (y_hi-0.5)/(delta_y/delta_x))
 
-        return y_median
\ No newline at end of file
+        return VTT, unrecovered
+
+    @staticmethod
+    def shuffleIndex(rng,NP,S,T):
+        """Random orders of the choice tasks of each respondent.
+
+        Parameters
+        ----------
+        rng : numpy.random.Generator
+            The random number generator.
+        NP : int
+            Number of respondents.
+        S : int
+            Number of shuffles per respondent.
+        T : int
+            Number of choice tasks per respondent.
+
+        Returns
+        -------
+        numpy.ndarray
+            An (NP, S, T+1) array of task indices. The first T indices of 
+            each shuffle are a permutation of the tasks, and the last one 
+            repeats a random task of the permutation.
+        """
+        # Sorting uniform draws gives a uniformly random permutation per respondent and shuffle
+        perm = np.argsort(rng.random((NP,S,T)),axis=2)
+        repeat = rng.integers(1,T-1,size=(NP,S,1))
+
+        return np.concatenate((perm,np.take_along_axis(perm,repeat,axis=2)),axis=2)
+
+    @staticmethod
+    def bisectVTT(self,clf,y,bounds,X,R,tol=0.01,rng=None,chunkSize=None):
+        """Recovers the VTT of each respondent by bisection of the point 
+        where the median simulated choice probability crosses 0.5.
+
+        The choices of each respondent are shuffled `R` times, as in 
+        `simulateNChoice`, and the shuffles are kept fixed during the 
+        bisection. Respondents are processed in blocks of `chunkSize`.
+
+        Parameters
+        ----------
+        bounds : tuple
+            Lower and upper bound of the VTT search.
+        tol : float
+            The bisection stops when the bracket of every respondent is 
+            narrower than `tol`.
+
+        Returns
+        -------
+        VTT : numpy.ndarray
+            The recovered VTT of each respondent, zero if not recovered.
+        unrecovered : numpy.ndarray
+            Boolean mask of the respondents whose choice probabilities at 
+            the bounds do not bracket 0.5.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+
+        NP, T = y.shape
+        if chunkSize is None:
+            chunkSize = NP
+        n_iter = max(0, int(np.ceil(np.log2((bounds[1]-bounds[0])/tol))))
+
+        VTT = np.zeros(NP)
+        unrecovered = np.zeros(NP, dtype=bool)
+        for start in range(0,NP,chunkSize):
+            stop = min(start+chunkSize,NP)
+            resp_index = np.arange(start,stop)[:,np.newaxis,np.newaxis]
+
+            # Random orders of the choices of each respondent, fixed during the bisection
+            rndp = np.argsort(rng.random((stop-start,R,T)),axis=2)
+            x_sim = np.empty((stop-start,R,2*T+1))
+            x_sim[:,:,:T] = y[resp_index,rndp]
+            x_sim[:,:,T+1:] = X[resp_index,rndp]
+
+            # Median simulated choice probability of each respondent at one VTT per respondent
+            def prob(v):
+                x_sim[:,:,T] = v[:,np.newaxis]
+                return np.median(ModelANN._predictProba(clf,x_sim.reshape(-1,2*T+1),self.scaler)[:,1].reshape(stop-start,R),axis=1)
+
+            # Bracket the crossing at the bounds of the search
+            x_lo = np.full(stop-start,float(bounds[0]))
+            x_hi = np.full(stop-start,float(bounds[1]))
+            f_lo = prob(x_lo) - 0.5
+            f_hi = prob(x_hi) - 0.5
+            bracketed = (f_lo*f_hi) < 0
+
+            # Bisection: keep the half of the bracket where the sign changes
+            for _ in range(n_iter):
+                x_mid = (x_lo + x_hi)/2
+                f_mid = prob(x_mid) - 0.5
+                left = np.sign(f_mid) != np.sign(f_lo)
+                x_hi = np.where(left, x_mid, x_hi)
+                f_hi = np.where(left, f_mid, f_hi)
+                x_lo = np.where(left, x_lo, x_mid)
+                f_lo = np.where(left, f_lo, f_mid)
+
+            # Linear interpolation of the crossing within the final bracket
+            with np.errstate(divide='ignore', invalid='ignore'):
+                VTT[start:stop] = np.where(bracketed, x_lo + f_lo*(x_hi-x_lo)/(f_lo-f_hi), 0.)
+            unrecovered[start:stop] = ~bracketed
+
+        return VTT, unrecovered
+
+    @staticmethod
+    def simulateNChoice(self,clf,y,vtt_grid,X,R,rng=None,chunkSize=None):
+        """Median choice probability of each respondent at each point of 
+        the VTT grid, over `R` random orders of the respondent's choices.
+
+        Respondents are simulated in blocks of `chunkSize`, so the memory 
+        used does not grow with the sample size. The results do not depend 
+        on `chunkSize`.
+        """
+        if rng is None:
+            rng = np.random.default_rng()
+
+        NP, T = y.shape
+        G = vtt_grid.shape[1]
+        if chunkSize is None:
+            chunkSize = NP
+
+        y_median = np.empty((NP,G))
+        for start in range(0,NP,chunkSize):
+            stop = min(start+chunkSize,NP)
+            resp_index = np.arange(start,stop)[:,np.newaxis,np.newaxis]
+
+            # Random orders of the choices of each respondent
+            rndp = np.argsort(rng.random((stop-start,R,T)),axis=2)
+
+            # Create simulated inputs: shuffled choices, the VTT grid point and shuffled BVTT
+            x_sim = np.empty((stop-start,R,G,2*T+1))
+            x_sim[:,:,:,:T] = y[resp_index,rndp][:,:,np.newaxis,:]
+            x_sim[:,:,:,T] = vtt_grid[start:stop,np.newaxis,:]
+            x_sim[:,:,:,T+1:] = X[resp_index,rndp][:,:,np.newaxis,:]
+
+            y_sim = ModelANN._predictProba(clf,x_sim.reshape(-1,2*T+1),self.scaler)[:,1].reshape(stop-start,R,G)
+            y_median[start:stop] = np.median(y_sim,axis=1)
+
+        return y_median
+
+# Forward pass of a trained ANN
+class _MLPPredictor:
+    """Choice probabilities of a fitted `MLPClassifier` with tanh hidden 
+    layers, computed with NumPy in single precision.
+
+    The weights are extracted once. If a fitted `StandardScaler` is given, 
+    it is folded into the first layer, so the predictor takes unscaled 
+    inputs. The inputs are processed in blocks of `blockSize` rows, using 
+    buffers that are allocated once.
+    """
+    def __init__(self, clf, scaler=None, blockSize=65536):
+        if clf.activation != 'tanh' or clf.out_activation_ != 'logistic':
+            raise ValueError('Only binary classifiers with tanh hidden layers are supported.')
+
+        coefs = [W.astype(np.float64) for W in clf.coefs_]
+        intercepts = [b.astype(np.float64) for b in clf.intercepts_]
+
+        # (x - mean)/scale @ W + b = x @ (W/scale) + (b - (mean/scale) @ W)
+        if scaler is not None:
+            intercepts[0] = intercepts[0] - (scaler.mean_/scaler.scale_) @ coefs[0]
+            coefs[0] = coefs[0]/scaler.scale_[:,np.newaxis]
+
+        self.coefs = [W.astype(np.float32) for W in coefs]
+        self.intercepts = [b.astype(np.float32) for b in intercepts]
+        self.blockSize = blockSize
+
+        self._input = np.empty((blockSize,self.coefs[0].shape[0]),dtype=np.float32)
+        self._layers = [np.empty((blockSize,W.shape[1]),dtype=np.float32) for W in self.coefs]
+
+    def predict_proba(self, x):
+        p = np.empty(x.shape[0])
+        for start in range(0,x.shape[0],self.blockSize):
+            n = min(self.blockSize,x.shape[0]-start)
+            a = self._input[:n]
+            a[...] = x[start:start+n]
+
+            for i in range(len(self.coefs)):
+                z = self._layers[i][:n]
+                np.matmul(a,self.coefs[i],out=z)
+                z += self.intercepts[i]
+                if i < len(self.coefs)-1:
+                    np.tanh(z,out=z)
+                a = z
+
+            # Logistic output layer
+            with np.errstate(over='ignore'):
+                p[start:start+n] = 1/(1+np.exp(-a[:,0].astype(np.float64)))
+
+        return np.c_[1-p,p]
+
+# Model of the worker processes that run training repeats in parallel
+_worker = {}
+
+def _initWorker(spec, cfg, arrays, scaler):
+    from threadpoolctl import threadpool_limits
+
+    # One BLAS thread per worker, as the repeats already use all cores
+    limiter = threadpool_limits(limits=1)
+
+    shared, blocks = _attach_shared(spec)
+    model = ModelANN.__new__(ModelANN)
+    model.cfg = cfg
+    model.arrays = arrays
+    model.scaler = scaler
+    for key, a in shared.items():
+        setattr(model, key, a)
+
+    _worker.update(model=model, blocks=blocks, limiter=limiter)
+
+def _trainRepeatWorker(seed, vtt_grid):
+    return _worker['model'].trainRepeat(seed, vtt_grid)
+
+def _searchTopologyWorker(hiddenLayerNodes, seed):
+    return _worker['model']._fitTopology(hiddenLayerNodes, seed)
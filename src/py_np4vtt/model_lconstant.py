@@ -8,6 +8,7 @@
 """Modules to configure and estimate a Local constant model."""
 
 from dataclasses import dataclass
+from typing import Optional, Union
 import numpy as np
 from scipy.stats import norm
 from py_np4vtt.data_format import ModelArrays
@@ -31,14 +32,25 @@ class ConfigLConstant:
     supportPoints : int
         Number of support points of the VTT grid. The VTT grid will contain 
         `(supportPoints-1)` intervals. Must be greater than zero
-    kernelWidth : float
+    kernelWidth : float or str
         Kernel width for the Nadaraya-Watson estimator. Must be greater than 
-        zero.
+        zero. If `'cv'`, the kernel width is selected by leave-one-out 
+        cross-validation over `bandwidths`.
+    bandwidths : numpy.ndarray, optional
+        Candidate kernel widths for the cross-validation. If None, 30 
+        log-spaced values between a rule-of-thumb width and 1/4 of the 
+        BVTT range (see `ModelLConstant.crossValidation`).
+    verbose : bool
+        Whether to print the VTT grid and the selected kernel width. 
+        Default is True
     """
     minimum: float
     maximum: float
     supportPoints: int
-    kernelWidth: float
+    kernelWidth: Union[float, str]
+
+    bandwidths: Optional[np.ndarray] = None
+    verbose: bool = True
 
     def validate(self):
         # Create errormessage list
@@ -50,8 +62,11 @@ class ConfigLConstant:
         if not self.supportPoints > 0:
             errorList.append('No. of support points must be greater than zero.')
 
-        if not self.kernelWidth > 0:
-            errorList.append('Kernel width must be greater than zero.')
+        if not (self.kernelWidth == 'cv' or (not isinstance(self.kernelWidth, str) and self.kernelWidth > 0)):
+            errorList.append("Kernel width must be greater than zero, or 'cv'.")
+
+        if self.bandwidths is not None and not np.all(np.asarray(self.bandwidths) > 0):
+            errorList.append('Candidate kernel widths must be greater than zero.')
 
         # Whoever calls this validator knows that empty errorList means validator success
         return errorList
@@ -75,11 +90,21 @@ class ModelLConstant:
         The VTT grid created with the specifications of `ConfigLConstant`
     vtt_mid : numpy.ndarray
         The mid points of the VTT grid.
+    kernelWidth : float
+        The kernel width used in the estimation. Set by `run()`.
+    bandwidths : numpy.ndarray
+        Candidate kernel widths of the cross-validation. Only set by 
+        `run()` when `kernelWidth='cv'`.
+    cv : numpy.ndarray
+        Leave-one-out cross-validation criterion at each candidate kernel 
+        width in `bandwidths`. Only set by `run()` when `kernelWidth='cv'`.
 
     Methods
     -------
     run():
         Estimates the local constant model.
+    selectBandwidth(bandwidths):
+        Selects the kernel width by leave-one-out cross-validation.
     
     References
     ----------
@@ -104,10 +129,11 @@ class ModelLConstant:
         dist = self.vtt_grid[1] - self.vtt_grid[0]
 
         # Print message of the support points
-        print("Created a VTT grid of " + str(self.params.supportPoints) + \
-            " points between " + str(self.params.minimum) + " and " + str(self.params.maximum) + ".")
+        if self.params.verbose:
+            print("Created a VTT grid of " + str(self.params.supportPoints) + \
+                " points between " + str(self.params.minimum) + " and " + str(self.params.maximum) + ".")
 
-        print("Distance between points of the VTT grid is " + str(dist))
+            print("Distance between points of the VTT grid is " + str(dist))
 
     def run(self):
         """Estimates the local constant model.
@@ -128,11 +154,27 @@ class ModelLConstant:
             CDF points (`p`) and the sample.
         est_time : float
             The estimation time in seconds.
+
+        Raises a ValueError if a mid point of the VTT grid lies below the 
+        smallest BVTT, where the estimator is not defined (earlier versions 
+        returned NaN).
         """
 
         # Start estimation
         t0 = time.time()
-        p = ModelLConstant.nadaraya_watson(self.vtt_mid[1:-1],~self.arrays.Choice.flatten(),self.arrays.BVTT.flatten(),self.params.kernelWidth)
+        X_u, n, Ysum = ModelLConstant.binned_statistics(~self.arrays.Choice.flatten(),self.arrays.BVTT.flatten())
+
+        # Select the kernel width if requested
+        if self.params.kernelWidth == 'cv':
+            self.kernelWidth, self.bandwidths, self.cv = ModelLConstant.crossValidation(X_u,n,Ysum,self.params.bandwidths)
+            if self.params.verbose:
+                print("Selected kernel width " + str(self.kernelWidth) + " by leave-one-out cross-validation.")
+                if self.kernelWidth in (self.bandwidths.min(), self.bandwidths.max()):
+                    print("Selected kernel width is at the boundary of the candidates. Consider extending the candidate kernel widths.")
+        else:
+            self.kernelWidth = self.params.kernelWidth
+
+        p = ModelLConstant.nadaraya_watson_binned(self.vtt_mid[1:-1],X_u,n,Ysum,self.kernelWidth)
 
         # Create counts per point of the VTT mid points
         vtt = predicted_vtt(p,self.vtt_grid,self.arrays.NP)
@@ -147,6 +189,146 @@ class ModelLConstant:
         # Return list of outcomes
         return p, vtt, est_time
 
+    def selectBandwidth(self, bandwidths=None):
+        """Selects the kernel width by leave-one-out cross-validation.
+
+        Parameters
+        ----------
+        bandwidths : numpy.ndarray, optional
+            Candidate kernel widths. Defaults to `bandwidths` of the 
+            configuration, or 30 log-spaced values between a rule-of-thumb 
+            width and 1/4 of the BVTT range.
+
+        Returns
+        -------
+        h : float
+            The kernel width that minimises the cross-validation criterion.
+        bandwidths : numpy.ndarray
+            The candidate kernel widths.
+        cv : numpy.ndarray
+            The cross-validation criterion at each candidate kernel width.
+        """
+        if bandwidths is None:
+            bandwidths = self.params.bandwidths
+
+        X_u, n, Ysum = ModelLConstant.binned_statistics(~self.arrays.Choice.flatten(),self.arrays.BVTT.flatten())
+        return ModelLConstant.crossValidation(X_u,n,Ysum,bandwidths)
+
+    # Leave-one-out cross-validation of the Nadaraya-Watson estimator, over binned data
+    @staticmethod
+    def crossValidation(X_u,n,Ysum,bandwidths=None):
+        """Leave-one-out cross-validation criterion of the Nadaraya-Watson 
+        estimator at several kernel widths.
+
+        Each observation is predicted with the one-sided estimator at its 
+        own BVTT, leaving the observation out. As the outcome is binary, 
+        the squared prediction errors of all observations with the same 
+        BVTT follow from `n` and `Ysum`, and all candidate kernel widths 
+        are evaluated together. Observations without other observations at 
+        or below their BVTT are left out of the criterion.
+
+        With many tied BVTT values, the criterion tends to decrease towards 
+        very small kernel widths, which undersmooth. The default candidates 
+        therefore start at the rule-of-thumb width 
+        `0.9*min(sd, IQR/1.34)*N^(-1/5)` of the BVTT and end at 1/4 of its 
+        range.
+
+        Returns
+        -------
+        h : float
+            The kernel width that minimises the criterion.
+        bandwidths : numpy.ndarray
+            The candidate kernel widths.
+        cv : numpy.ndarray
+            Mean squared leave-one-out prediction error at each candidate.
+        """
+        if bandwidths is None:
+            X = np.repeat(X_u, n)
+            h_rot = 0.9*min(np.std(X), np.subtract(*np.quantile(X, [0.75, 0.25]))/1.34)*len(X)**(-0.2)
+            bandwidths = np.geomspace(h_rot, max((X_u[-1] - X_u[0])/4, 2*h_rot), 30)
+        bandwidths = np.asarray(bandwidths, dtype=float)
+
+        # Kernel sums over the values strictly below each unique value, in blocks of rows to bound memory
+        U = len(X_u)
+        A = np.empty((len(bandwidths), U))
+        B = np.empty((len(bandwidths), U))
+        block = max(1, 2**22 // (len(bandwidths)*U))
+        for start in range(0, U, block):
+            D = X_u[start:start+block,np.newaxis] - X_u[np.newaxis,:]
+            K = np.exp(-0.5*(D[np.newaxis,:,:]/bandwidths[:,np.newaxis,np.newaxis])**2) * (D > 0)
+            A[:,start:start+block] = K @ Ysum
+            B[:,start:start+block] = K @ n
+
+        # Add the observations at the same value. The constant of the gaussian kernel cancels out
+        A = A + Ysum
+        B = B + n
+        loo = B - 1
+
+        # Sum of squared errors per unique value: sum_i (B*Y_i - A)^2 / (B - 1)^2, with Y_i^2 = Y_i
+        valid = np.all(loo > 0, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sse = (B**2*Ysum - 2*A*B*Ysum + n*A**2)/loo**2
+        cv = np.sum(sse[:,valid], axis=1)/np.sum(n[valid])
+
+        h = bandwidths[np.argmin(cv)]
+
+        return h, bandwidths, cv
+
+    # Counts and sums of the outcome per unique value of the regressor
+    @staticmethod
+    def binned_statistics(Y,X):
+        """Reduces the data to sufficient statistics per unique value of `X`.
+
+        Missing values of `X` (unbalanced panels) are dropped.
+
+        Parameters
+        ----------
+        Y : numpy.ndarray
+            The outcome (acceptance of the cheap alternative).
+        X : numpy.ndarray
+            The regressor (BVTT).
+
+        Returns
+        -------
+        X_u : numpy.ndarray
+            The unique values of `X`, in ascending order.
+        n : numpy.ndarray
+            Number of observations at each unique value.
+        Ysum : numpy.ndarray
+            Sum of `Y` at each unique value.
+        """
+        valid = ~np.isnan(X)
+        X_u, inv = np.unique(X[valid], return_inverse=True)
+        n = np.bincount(inv, minlength=len(X_u))
+        Ysum = np.bincount(inv, weights=Y[valid], minlength=len(X_u))
+
+        return X_u, n, Ysum
+
+    # Nadaraya-Watson estimator with one-sided gaussian kernel, over binned data
+    @staticmethod
+    def nadaraya_watson_binned(x,X_u,n,Ysum,h):
+        """Nadaraya-Watson estimator over the output of `binned_statistics`.
+
+        Gives the same estimates as `nadaraya_watson`, with a cost that 
+        depends on the number of unique values of `X` instead of the 
+        number of observations. The kernel weights of each evaluation 
+        point are scaled by the weight of the nearest value below it, so 
+        they do not underflow far from the data.
+
+        Raises a ValueError if an evaluation point has no observation at 
+        or below it.
+        """
+        # Kernel weight of each unique value at each evaluation point, only for values below the point
+        below = X_u[np.newaxis,:] <= x[:,np.newaxis]
+        if not np.all(np.any(below, axis=1)):
+            raise ValueError('No observations at or below evaluation point(s) ' + str(x[~np.any(below, axis=1)]) + \
+                '. Increase the minimum of the VTT grid.')
+        z = (x[:,np.newaxis] - X_u[np.newaxis,:])/h
+        z_min = np.min(np.where(below, z, np.inf), axis=1)
+        K = np.exp(-0.5*(z**2 - z_min[:,np.newaxis]**2)) * below
+
+        return (K @ Ysum)/(K @ n)
+
     # Nadaraya-Watson estimator with gaussian kernel
     @staticmethod
     def nadaraya_watson(x,Y,X,h):
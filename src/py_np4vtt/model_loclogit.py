@@ -9,7 +9,9 @@
 from dataclasses import dataclass
 import numpy as np
 from py_np4vtt.data_format import ModelArrays
-from py_np4vtt.utils import vtt_midpoints, predicted_vtt, _bfgsmin
+from py_np4vtt.utils import vtt_midpoints, predicted_vtt, minimize, _SharedArrays, _attach_shared, vectorized
+from concurrent.futures import ProcessPoolExecutor
+import os
 import time
 
 @dataclass
@@ -29,11 +31,25 @@ class ConfigLocLogit:
     supportPoints : int
         Number of support points of the VTT grid. The VTT grid will contain
         `(supportPoints-1)` intervals. Must be greater than zero
+    optimizer : str
+        Estimation routine of the local logits. `'bfgs'` (default), 
+        `'lbfgs'` and `'L-BFGS-B'` estimate each local logit separately 
+        (see `utils.minimize`). `'newton'` estimates all local logits at 
+        once, with Newton iterations that use the analytic gradient and 
+        Hessian of each local logit.
+    n_jobs : int
+        Number of worker processes that estimate the local logits 
+        separately. The sorted BVTT and choices are shared with 
+        the workers through shared memory. `-1` uses all available cores. 
+        The results do not depend on the number of workers. Default is 1
     """
     minimum: float
     maximum: float
     supportPoints: int
 
+    optimizer: str = 'bfgs'
+    n_jobs: int = 1
+
     def validate(self):
         # Create errormessage list
         errorList = []
@@ -44,6 +60,12 @@ class ConfigLocLogit:
         if not self.supportPoints > 0:
             errorList.append('No. of support points must be greater than zero.')
 
+        if self.optimizer not in ('bfgs', 'lbfgs', 'L-BFGS-B', 'newton'):
+            errorList.append("Optimizer must be either 'bfgs', 'lbfgs', 'L-BFGS-B' or 'newton'.")
+
+        if not (self.n_jobs > 0 or self.n_jobs == -1):
+            errorList.append('No. of jobs must be greater than zero, or -1 to use all cores.')
+
         # Whoever calls this validator knows that empty errorList means validator success
         return errorList
 
@@ -66,6 +88,9 @@ class ModelLocLogit:
         The VTT grid created with the specifications of `ConfigLocLogit`.
     vtt_mid : numpy.ndarray
         The mid points of the VTT grid.
+    results : list
+        Result (`OptimizeResult`) of the local logit of each support 
+        point, available after `run()` unless `optimizer='newton'`.
 
     Methods
     -------
@@ -126,14 +151,37 @@ class ModelLocLogit:
 
         YX = self.arrays.Choice.T.flatten()
 
+        # Sort the observations by BVTT once, so the kernel window of each support point is a slice
+        BVTT_flat = self.arrays.BVTT.T.flatten()
+        order = np.argsort(BVTT_flat, kind='stable')
+        BVTT_sorted = BVTT_flat[order]
+        YX_sorted = YX[order]
+
         # Perform a weighted logit for each support point
         t0 = time.time()
-        p = []
-        fval = 0.
-        for n in range(len(self.vtt_grid)-1):
-            x, fval_x = ModelLocLogit.initLocalLogit(n, k[n], self.arrays.BVTT, YX, self.vtt_grid)
-            p.append(x[0])
-            fval = fval + fval_x
+        if self.params.optimizer == 'newton':
+            x, fval_x = ModelLocLogit.batchedLocalLogit(k, BVTT_sorted, YX_sorted, self.vtt_grid)
+            p = list(x[:,0])
+            fval = np.sum(fval_x)
+        else:
+            n_points = len(self.vtt_grid)-1
+            n_jobs = os.cpu_count() if self.params.n_jobs == -1 else self.params.n_jobs
+            n_jobs = min(n_jobs, n_points)
+            if n_jobs > 1:
+                with _SharedArrays(BVTT=BVTT_sorted, YX=YX_sorted) as shared:
+                    with ProcessPoolExecutor(n_jobs, initializer=_initWorker, initargs=(shared.spec, self.vtt_grid, self.params.optimizer)) as executor:
+                        results = list(executor.map(_localLogitWorker, range(n_points), k, chunksize=max(1, n_points // (4*n_jobs))))
+            else:
+                results = [ModelLocLogit.initLocalLogit(n, k[n], BVTT_sorted, YX_sorted, self.vtt_grid, self.params.optimizer) for n in range(n_points)]
+
+            # Collect the results in support point order, so the log-likelihood is the same for any number of workers
+            p = []
+            fval = 0.
+            self.results = []
+            for x, fval_x, results_x in results:
+                p.append(x[0])
+                fval = fval + fval_x
+                self.results.append(results_x)
 
         # Compute elapsed time
         t1 = time.time()
@@ -152,34 +200,154 @@ class ModelLocLogit:
         return p, vtt, ll, est_time
 
     @staticmethod
-    def initLocalLogit(n, k, BVTT, YX, vtt_grid):
-        # Get observations
-        BVTT_flat = BVTT.T.flatten()
-        xn = BVTT_flat[(BVTT_flat > (vtt_grid[n]-k)) & (BVTT_flat < (vtt_grid[n] + k))]
+    def initLocalLogit(n, k, BVTT_sorted, YX_sorted, vtt_grid, method='bfgs'):
+        # Get observations in the open window (vtt_grid[n]-k, vtt_grid[n]+k) of the sorted BVTT
+        lo, hi = ModelLocLogit.kernelWindow(BVTT_sorted, vtt_grid[n], k)
+        xn = BVTT_sorted[lo:hi]
         x0 = vtt_grid[n]
-        y_local = YX[(BVTT_flat > (vtt_grid[n]-k)) & (BVTT_flat < (vtt_grid[n] + k))]
+        y_local = YX_sorted[lo:hi]
         dist = np.abs(x0-xn)
         weight = (k-dist)/k
 
         # Search function
         coef_start = np.array([0., 0.])
         args = (y_local, xn, x0, weight)
-        results = _bfgsmin(ModelLocLogit.objectiveFunction, coef_start, args=args, tol=1e-6,verbose=False)
+        results = minimize(ModelLocLogit.objectiveFunction, coef_start, method=method, args=args, tol=1e-6, verbose=False)
 
         # Collect results
-        x = results['x']
-        fval = results['fun']
+        x = results.x
+        fval = results.fun
 
         # Convert to probabilities
-        x = 1 - (np.exp(x)/(1+np.exp(x)))
+        with np.errstate(over='ignore'):
+            x = 1/(1+np.exp(x))
+
+        return x, fval, results
+
+    @staticmethod
+    def batchedLocalLogit(k, BVTT_sorted, YX_sorted, vtt_grid, maxiter=100, tol=1e-6):
+        """Estimates the local logits of all support points at once.
+
+        The observations in the kernel window of each support point are 
+        stacked in one long array. The gradient and Hessian of each local 
+        logit are 2x2 sums over its window, so every Newton iteration 
+        updates all support points with a few array operations.
+
+        Parameters
+        ----------
+        k : numpy.ndarray
+            Kernel width at each support point.
+        BVTT_sorted : numpy.ndarray
+            Flattened BVTT, sorted in ascending order.
+        YX_sorted : numpy.ndarray
+            Flattened choices, in the same order as `BVTT_sorted`.
+        vtt_grid : numpy.ndarray
+            The VTT grid.
+        maxiter : int
+            Maximum number of Newton iterations.
+        tol : float
+            Tolerance on the Newton decrement of every local logit.
+
+        Returns
+        -------
+        x : numpy.ndarray
+            Estimated choice probability at each support point, in the 
+            first column, and the transformed slope in the second.
+        fval : numpy.ndarray
+            Weighted negative log-likelihood of each local logit.
+        """
+        # Stack the observations in the kernel window of each support point
+        n_points = len(vtt_grid)-1
+        lo, hi = ModelLocLogit.kernelWindow(BVTT_sorted, vtt_grid[:n_points], k)
+        size = hi - lo
+        point = np.repeat(np.arange(n_points), size)
+        idx = np.arange(size.sum()) + np.repeat(lo - np.r_[0, np.cumsum(size)[:-1]], size)
+
+        dx = BVTT_sorted[idx] - vtt_grid[point]
+        y_local = YX_sorted[idx] == 1
+        weight = (k[point] - np.abs(dx))/k[point]
+
+        # Sums over the kernel window of each support point
+        wsum = lambda v: np.bincount(point, weights=weight*v, minlength=n_points)
+
+        # Weighted negative log-likelihood of each local logit (stable log-sigmoid)
+        def nll(coef):
+            acc = coef[point,0] + coef[point,1]*dx
+            return wsum(np.logaddexp(0., np.where(y_local, -acc, acc)))
+
+        coef = np.zeros((n_points, 2))
+        fval = nll(coef)
+        for iter in range(maxiter):
+
+            # Gradient and Hessian of each local logit
+            acc = coef[point,0] + coef[point,1]*dx
+            with np.errstate(over='ignore'):
+                P = 1/(1+np.exp(-acc))
+            r = P - y_local
+            g0, g1 = wsum(r), wsum(r*dx)
+            v = P*(1-P)
+            h00, h01, h11 = wsum(v), wsum(v*dx), wsum(v*dx**2)
+
+            # Newton direction from the closed-form inverse of each 2x2 Hessian. A small ridge 
+            # keeps the direction defined when all observations of a window share the same BVTT
+            ridge = 1e-10*(h00 + h11)
+            h00, h11 = h00 + ridge, h11 + ridge
+            det = np.maximum(h00*h11 - h01**2, np.finfo(float).tiny)
+            d = -np.c_[(h11*g0 - h01*g1)/det, (h00*g1 - h01*g0)/det]
+
+            # Stop when the Newton decrement of all local logits is below tolerance
+            decrement = -(d[:,0]*g0 + d[:,1]*g1)
+            active = decrement >= tol
+            if not active.any():
+                break
+            d[~active] = 0.
+
+            # Halve the step of each local logit until its objective function does not increase
+            step = np.ones(n_points)
+            for _ in range(30):
+                fval_new = nll(coef + step[:,np.newaxis]*d)
+                worse = ~(fval_new <= fval)
+                if not worse.any():
+                    break
+                step[worse] = step[worse]/2
+            step[worse] = 0.
+
+            coef = coef + step[:,np.newaxis]*d
+            fval = nll(coef)
+
+        # Convert to probabilities
+        with np.errstate(over='ignore'):
+            x = 1/(1+np.exp(coef))
 
         return x, fval
 
     @staticmethod
+    def kernelWindow(BVTT_sorted, x0, k):
+        """Returns the slice bounds of the observations with 
+        `x0 - k < BVTT < x0 + k` in the sorted BVTT array.
+        """
+        lo = np.searchsorted(BVTT_sorted, x0 - k, side='right')
+        hi = np.searchsorted(BVTT_sorted, x0 + k, side='left')
+        return lo, hi
+
+    @staticmethod
+    @vectorized
     def objectiveFunction(coef: np.ndarray, y_local: np.ndarray, xn: np.ndarray, x0: np.ndarray, weight: np.ndarray):
-        acc = coef[0] + coef[1]*(xn-x0)
+        # coef is either one set of coefficients, or an (M, 2) matrix with one set per row
+        coef = np.asarray(coef)
+        acc = coef[...,0,np.newaxis] + coef[...,1,np.newaxis]*(xn-x0)
         P = np.exp(acc)/(1+np.exp(acc))
         LL = np.log(P*(y_local == 1) + (1-P)*(y_local == 0))
-        LLw = -sum(weight*LL)
+        LLw = -np.sum(weight*LL,axis=-1)
 
         return LLw
+
+# Data of the worker processes that estimate local logits in parallel
+_worker = {}
+
+def _initWorker(spec, vtt_grid, method):
+    arrays, blocks = _attach_shared(spec)
+    _worker.update(arrays, blocks=blocks, vtt_grid=vtt_grid, method=method)
+
+def _localLogitWorker(n, k):
+    return ModelLocLogit.initLocalLogit(n, k, _worker['BVTT'], _worker['YX'], _worker['vtt_grid'], _worker['method'])
@@ -7,12 +7,14 @@
 #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """Modules to configure and estimate a Logistic regression-based model."""
 from dataclasses import dataclass
-from typing import Optional, Tuple
-from numdifftools import Hessian
+from functools import partial
+from typing import Callable, Optional, Tuple
 import numpy as np
+import os
 import warnings
 import time
-from py_np4vtt.utils import _bfgsmin
+from concurrent.futures import ProcessPoolExecutor
+from py_np4vtt.utils import minimize, multistart, METHODS, StdErrors
 
 from py_np4vtt.data_format import ModelArrays
 
@@ -38,6 +40,49 @@ class ConfigLogistic:
         Maximum number of iterations of the estimation routine.
     seed: Optional[int]
         Random seed
+    seMethod : Optional[str]
+        Method to compute the standard errors: `'hessian'`, `'opg'` 
+        (outer product of the scores) or `'sandwich'`. If `'lazy'`, the 
+        standard errors are not computed during the estimation and can be 
+        requested afterwards with `stdErrors`. Default is `'hessian'` with 
+        one held-out choice per respondent, and `'sandwich'` (clustered by 
+        respondent) with more than one, as the inverse Hessian treats the 
+        stacked draws as independent and understates the standard errors.
+    optimizer : str
+        Estimation routine: `'bfgs'` (default), `'lbfgs'`, `'newton'`, 
+        which uses the analytic Hessian of the log-likelihood function, 
+        `'L-BFGS-B'` or `'trust-exact'` (see `utils.minimize`).
+    draws : int
+        Number of random held-out choices per respondent. The model is 
+        estimated once on all draws stacked together, and once on each 
+        draw to measure the draw-to-draw variance. Default is 1
+    heldOut : str
+        `'random'` (default) holds out `draws` random choices per 
+        respondent, drawn among the first T-1 choices as in earlier 
+        versions (the last choice is never held out). `'all'` uses each of 
+        the T choices of every respondent as held-out choice once (`draws` 
+        is ignored).
+    starts : int
+        Number of starting values. The first one is the configured 
+        starting values, the others add normal draws with standard 
+        deviation `startSD`. The start with the highest log-likelihood is 
+        kept. Default is 1
+    startSD : float
+        Standard deviation of the draws of the starting values. Default 
+        is 1
+    startCutoff : Optional[float]
+        If given, starts whose log-likelihood is more than `startCutoff` 
+        below the best one after 10 iterations are abandoned.
+    n_jobs : int
+        Number of worker processes that estimate the model on each draw, 
+        or from each start. `-1` uses all available cores. Default is 1
+    verbose : bool
+        Whether to print the progress of the estimation. Default is True
+    callback : Optional[Callable]
+        Called after each iteration of the estimation routine as 
+        `callback(iteration, x, fun, gnorm, step)` (see `utils.minimize`). 
+        With `n_jobs > 1`, it may run in the worker processes and must be 
+        picklable.
     """
     startScale: float
     startIntercept: float
@@ -47,6 +92,17 @@ class ConfigLogistic:
 
     seed: Optional[int]
 
+    seMethod: Optional[str] = None
+    optimizer: str = 'bfgs'
+    draws: int = 1
+    heldOut: str = 'random'
+    n_jobs: int = 1
+    starts: int = 1
+    startSD: float = 1.
+    startCutoff: Optional[float] = None
+    verbose: bool = True
+    callback: Optional[Callable] = None
+
     def validate(self):
         # Create errormessage list
         errorList = []
@@ -60,6 +116,30 @@ class ConfigLogistic:
         if not self.seed >= 0:
             errorList.append('Seed must be non-negative.')
 
+        if self.seMethod is not None and self.seMethod not in StdErrors.methods + ('lazy',):
+            errorList.append("Standard errors method must be either 'hessian', 'opg', 'sandwich' or 'lazy'.")
+
+        if self.optimizer not in METHODS:
+            errorList.append('Optimizer must be one of ' + ', '.join("'" + m + "'" for m in METHODS) + '.')
+
+        if not self.draws > 0:
+            errorList.append('Number of draws must be greater than zero.')
+
+        if self.heldOut not in ('random', 'all'):
+            errorList.append("Held-out choices must be either 'random' or 'all'.")
+
+        if not self.starts > 0:
+            errorList.append('No. of starts must be greater than zero.')
+
+        if not self.startSD >= 0:
+            errorList.append('Standard deviation of the starting values must be non-negative.')
+
+        if self.startCutoff is not None and not self.startCutoff > 0:
+            errorList.append('Cutoff of the starts must be positive.')
+
+        if not (self.n_jobs > 0 or self.n_jobs == -1):
+            errorList.append('No. of jobs must be greater than zero, or -1 to use all cores.')
+
         # Whoever calls this validator knows that empty errorList means validator success
         return errorList
 
@@ -78,7 +158,30 @@ class ModelLogistic:
         
     Attributes
     ----------
-    None.
+    stdErrors : StdErrors
+        Standard errors of the estimated parameters, available after 
+        `run()`. Call `stdErrors(method)` to compute them with another 
+        method. With more than one draw, the scores are summed per 
+        respondent, so `'sandwich'` accounts for the stacked draws.
+    drawEstimates : numpy.ndarray
+        Estimated parameters on each draw separately (one row per draw), 
+        available after `run()` with more than one draw.
+    drawVariance : numpy.ndarray
+        Draw-to-draw variance of the estimated parameters, available 
+        after `run()` with more than one draw.
+    results : OptimizeResult
+        Result of the estimation routine on the stacked draws, available 
+        after `run()`.
+    startEstimates : numpy.ndarray
+        Estimated parameters of each start (one row per start), available 
+        after `run()` with more than one start.
+    startLogLik : numpy.ndarray
+        Log-likelihood at the optimum of each start (NaN for abandoned 
+        starts), available after `run()` with more than one start.
+    timing : dict
+        Wall time in seconds of the optimisation (`'optimisation'`), of 
+        the Hessian and standard errors (`'hessian'`) and of the rest of 
+        the estimation (`'postprocessing'`), available after `run()`.
     """
     def __init__(self, cfg: ConfigLogistic, arrays: ModelArrays):
         self.cfg = cfg
@@ -117,19 +220,43 @@ class ModelLogistic:
         if self.cfg.seed:
             np.random.seed(self.cfg.seed)
 
-        # Prepare data
-        i_obs_y = \
-            np.tile(np.random.randint(1, self.arrays.T, size=(self.arrays.NP, 1)), (1, self.arrays.T)) == \
-            np.tile(np.arange(1, self.arrays.T + 1), (self.arrays.NP, 1))
+        # Prepare data: held-out choice of each respondent (rows) and draw (columns)
+        if self.cfg.heldOut == 'all':
+            i_obs_y = np.eye(self.arrays.T, dtype=bool)[np.newaxis,:,:]
+        else:
+            i_obs_y = \
+                np.random.randint(1, self.arrays.T, size=(self.arrays.NP, self.cfg.draws))[:,:,np.newaxis] == \
+                np.arange(1, self.arrays.T + 1)[np.newaxis,np.newaxis,:]
         
         i_obs_x = (i_obs_y == 0)
 
         # Set vector of starting values of parameters to estimate
         x0 = np.array([self.cfg.startScale, self.cfg.startIntercept, self.cfg.startParameter])
 
-        BVTT=np.sum(i_obs_y * self.arrays.BVTT, axis=1)
-        sumYBVTT=np.sum(i_obs_x * self.arrays.BVTT * self.arrays.Choice, axis=1)
-        y_regress=np.sum(self.arrays.Choice * i_obs_y, axis=1)
+        BVTT=np.sum(i_obs_y * self.arrays.BVTT[:,np.newaxis,:], axis=2)
+        sumYBVTT=np.sum(i_obs_x * (self.arrays.BVTT * self.arrays.Choice)[:,np.newaxis,:], axis=2)
+        y_regress=np.sum(self.arrays.Choice[:,np.newaxis,:] * i_obs_y, axis=2)
+        n_draws = BVTT.shape[1]
+
+        # Start the clock, including the estimation on each draw
+        t0 = time.time()
+
+        # Estimate on each draw separately, to measure the draw-to-draw variance
+        if n_draws > 1:
+            drawArgs = [(sumYBVTT[:,d], BVTT[:,d], y_regress[:,d]) for d in range(n_draws)]
+            n_jobs = os.cpu_count() if self.cfg.n_jobs == -1 else self.cfg.n_jobs
+            n_jobs = min(n_jobs, n_draws)
+            if n_jobs > 1:
+                with ProcessPoolExecutor(n_jobs) as executor:
+                    drawResults = list(executor.map(ModelLogistic._fitDraw, [self.cfg]*n_draws, drawArgs, [x0]*n_draws))
+            else:
+                drawResults = [ModelLogistic._fitDraw(self.cfg, args, x0) for args in drawArgs]
+            self.drawEstimates = np.array([r.x for r in drawResults])
+            self.drawVariance = np.var(self.drawEstimates, axis=0, ddof=1)
+
+        # Stack the draws of all respondents
+        BVTT, sumYBVTT, y_regress = BVTT.ravel(), sumYBVTT.ravel(), y_regress.ravel()
+        clusters = np.repeat(np.arange(self.arrays.NP), n_draws) if n_draws > 1 else None
 
         # LL at the start values
         init_ll = -ModelLogistic.objectiveFunction(x0, sumYBVTT, BVTT, y_regress)
@@ -138,26 +265,51 @@ class ModelLogistic:
         argTuple = (sumYBVTT, BVTT, y_regress)
         
         # Start minimization routine
-        t0 = time.time()
-        results = _bfgsmin(ModelLogistic.objectiveFunction, x0, args=argTuple,tol=1e-6, maxiter= self.cfg.maxIterations,verbose=True)
+        if self.cfg.starts > 1:
+            self.results, startResults, active = multistart(partial(ModelLogistic._fitDraw, self.cfg, argTuple), x0, self.cfg.starts, self.cfg.maxIterations,
+                                                            sd=self.cfg.startSD, seed=self.cfg.seed, n_jobs=self.cfg.n_jobs, cutoff=self.cfg.startCutoff)
+            self.startEstimates = np.array([r.x for r in startResults])
+            self.startLogLik = np.where(active, [-r.fun for r in startResults], np.nan)
+            if self.cfg.verbose:
+                print('Best of ' + str(self.cfg.starts) + ' starts. Log-likelihood of the optima between ' + \
+                    str(round(np.nanmin(self.startLogLik),2)) + ' and ' + str(round(np.nanmax(self.startLogLik),2)) + '.')
+        else:
+            self.results = ModelLogistic._fitDraw(self.cfg, argTuple, x0, self.cfg.maxIterations, verbose=self.cfg.verbose)
+        results = self.results
 
         # Compute elapsed time
         t1 = time.time()
         est_time = t1 - t0
+        t_opt = t1
 
         # Collect results
-        x = results['x']
-        hess = Hessian(ModelLogistic.objectiveFunction,method='forward')(x,sumYBVTT, BVTT, y_regress)
-        se = np.sqrt(np.diag(np.linalg.inv(hess)))
-        ll = -results['fun']
-        exitflag = results['convergence']
+        x = results.x
+        self.stdErrors = StdErrors(x, hessian=ModelLogistic.hessian, scores=ModelLogistic.scores, args=argTuple, clusters=clusters)
+        seMethod = self.cfg.seMethod
+        if seMethod is None:
+            seMethod = 'sandwich' if n_draws > 1 else 'hessian'
+        if seMethod == 'lazy':
+            se = np.full(len(x), np.nan)
+        else:
+            se = self.stdErrors(seMethod)
+        t_se = time.time()
+        ll = -results.fun
+        exitflag = results.convergence
 
         # Compute VTT
         vtt = x[1] + x[2]*((self.arrays.T-1)/self.arrays.T)*np.sum(self.arrays.Choice*self.arrays.BVTT,1)
         vtt = np.concatenate((0.,vtt),axis=None)
+
+        self.timing = {'optimisation': t_opt - t0, 'hessian': t_se - t_opt, 'postprocessing': time.time() - t_se}
         
         return x, se, vtt, init_ll ,ll, exitflag, est_time
 
+    @staticmethod
+    def _fitDraw(cfg, argTuple, x0, maxiter=None, verbose=False):
+        return minimize(ModelLogistic.objectiveFunction, x0, method=cfg.optimizer, jac=ModelLogistic.gradient, hess=ModelLogistic.hessian,
+                        args=argTuple, maxiter=cfg.maxIterations if maxiter is None else maxiter, tol=1e-6, verbose=verbose,
+                        callback=cfg.callback)
+
     @staticmethod
     def objectiveFunction(x: np.ndarray, sumYBVTT: np.ndarray, BVTT: np.ndarray, y_regress: np.ndarray):
         
@@ -170,12 +322,47 @@ class ModelLogistic:
         V2 = scale * VTT
 
         dV = V1 - V2
-        dV[dV>700] = 700
 
-        # Create choice probability and Log-likelihood
-        p = 1 / (1 + np.exp(-dV))
-        ll = np.log(p * (y_regress == 0) + (1 - p) * (y_regress == 1))
-        ll[~np.isfinite(ll)] = 0
+        # Log-likelihood, with the choice probability p = 1/(1+exp(-dV)) of y_regress == 0 and a stable log-sigmoid
+        ll = -np.logaddexp(0., np.where(y_regress == 0, -dV, dV))
         
         # Return choice probability
-        return -np.sum(ll)
\ No newline at end of file
+        return -np.sum(ll)
+
+    @staticmethod
+    def gradient(x: np.ndarray, sumYBVTT: np.ndarray, BVTT: np.ndarray, y_regress: np.ndarray):
+        return np.sum(ModelLogistic.scores(x, sumYBVTT, BVTT, y_regress), axis=0)
+
+    @staticmethod
+    def hessian(x: np.ndarray, sumYBVTT: np.ndarray, BVTT: np.ndarray, y_regress: np.ndarray):
+        # Separate parameters: x is the estimated (multi-dimensional) parameter
+        scale, intercept, parameter = x
+
+        # Choice probability
+        VTT = intercept + parameter * sumYBVTT
+        dV = scale * (BVTT - VTT)
+        with np.errstate(over='ignore'):
+            p = 1 / (1 + np.exp(-dV))
+        r = (y_regress == 0) - p
+
+        # Gauss-Newton term with the derivatives of dV, plus the second derivatives of dV (scale with intercept and parameter)
+        J = np.c_[BVTT - VTT, np.full(len(BVTT), -scale), -scale*sumYBVTT]
+        H = (J * (p*(1-p))[:,np.newaxis]).T @ J
+        H[0,1] = H[1,0] = H[0,1] + np.sum(r)
+        H[0,2] = H[2,0] = H[0,2] + np.sum(r*sumYBVTT)
+
+        return H
+
+    @staticmethod
+    def scores(x: np.ndarray, sumYBVTT: np.ndarray, BVTT: np.ndarray, y_regress: np.ndarray):
+        # Separate parameters: x is the estimated (multi-dimensional) parameter
+        scale, intercept, parameter = x
+
+        # Choice probability
+        VTT = intercept + parameter * sumYBVTT
+        dV = scale * (BVTT - VTT)
+        with np.errstate(over='ignore'):
+            p = 1 / (1 + np.exp(-dV))
+
+        # Gradient of the negative log-likelihood of each respondent
+        return -((y_regress == 0) - p)[:,np.newaxis] * np.c_[BVTT - VTT, np.full(len(BVTT), -scale), -scale*sumYBVTT]
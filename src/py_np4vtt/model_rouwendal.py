@@ -7,16 +7,19 @@
 #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """Modules to configure and estimate a Rouwendal model."""
 from dataclasses import dataclass
-from typing import Tuple
-from numdifftools import Hessian
+from functools import partial
+from typing import Callable, Optional, Tuple
 import numpy as np
 import warnings
 from py_np4vtt.data_format import ModelArrays
-from py_np4vtt.utils import vtt_midpoints, predicted_vtt,_bfgsmin
+from py_np4vtt.utils import vtt_midpoints, predicted_vtt, minimize, multistart, METHODS, OptimizeResult, StdErrors, _Trace
 import time
 
 warnings.filterwarnings('ignore')
 
+# Estimation routines of the model. Newton's method is left out since the Hessian is singular along a common shift of the density parameters
+OPTIMIZERS = tuple(m for m in METHODS if m != 'newton') + ('em', 'squarem')
+
 @dataclass
 class ConfigRouwendal:
     """Configuration class of the Rouwendal model.
@@ -37,12 +40,68 @@ class ConfigRouwendal:
     startQ : float
         Starting value of the probability of consistent choice. Must be
         between zero and one.
+    optimizer : str
+        Estimation routine. `'bfgs'` (default) maximises the log-likelihood 
+        over the logit of Q and the density parameters, as do `'lbfgs'`, 
+        `'L-BFGS-B'` and `'trust-exact'` (see `utils.minimize`). `'newton'` 
+        is not available: the density parameters are only identified up to 
+        a constant, so the Hessian is singular. 
+        `'em'` uses the EM algorithm, which updates the density and Q in 
+        closed form at each iteration, and `'squarem'` is its accelerated 
+        version [1].
+    maxIterations : int
+        Maximum number of iterations of the estimation routine.
+    seMethod : str
+        Method to compute the standard errors: `'hessian'` (default), 
+        `'opg'` (outer product of the scores) or `'sandwich'`. If 
+        `'lazy'`, the standard errors are not computed during the 
+        estimation and can be requested afterwards with `stdErrors`.
+    starts : int
+        Number of starting values. The first one is given by `startQ` 
+        and zero density parameters, the others add normal draws with 
+        standard deviation `startSD`. The start with the highest 
+        log-likelihood is kept. Default is 1
+    startSD : float
+        Standard deviation of the draws of the starting values. Default 
+        is 1
+    startCutoff : Optional[float]
+        If given, starts whose log-likelihood is more than `startCutoff` 
+        below the best one after 10 iterations are abandoned.
+    seed : Optional[int]
+        Random seed of the starting values.
+    n_jobs : int
+        Number of worker processes that run the starts. `-1` uses all 
+        available cores. Default is 1
+    verbose : bool
+        Whether to print the progress of the estimation. Default is True
+    callback : Optional[Callable]
+        Called after each iteration of the estimation routine as 
+        `callback(iteration, x, fun, gnorm, step)` (see `utils.minimize`). 
+        With `n_jobs > 1`, it may run in the worker processes and must be 
+        picklable.
+
+    References
+    ----------
+    [1] Varadhan, Ravi, and Christophe Roland. "Simple and globally 
+    convergent methods for accelerating the convergence of any EM 
+    algorithm." Scandinavian Journal of Statistics 35.2 (2008): 335-353.
     """
     minimum: float
     maximum: float
     supportPoints: int
     startQ: float
 
+    optimizer: str = 'bfgs'
+    maxIterations: int = 1000
+    seMethod: str = 'hessian'
+    starts: int = 1
+    startSD: float = 1.
+    startCutoff: Optional[float] = None
+    seed: Optional[int] = None
+    n_jobs: int = 1
+    verbose: bool = True
+    callback: Optional[Callable] = None
+
     def validate(self):
         # Create errormessage list
         errorList = []
@@ -56,6 +115,27 @@ class ConfigRouwendal:
         if not (0 < self.startQ < 1):
             errorList.append('Probability of consistent choice must be in the interval (0,1).')
 
+        if self.optimizer not in OPTIMIZERS:
+            errorList.append('Optimizer must be one of ' + ', '.join("'" + m + "'" for m in OPTIMIZERS) + '.')
+
+        if not self.maxIterations > 0:
+            errorList.append('Max iterations must be greater than zero.')
+
+        if self.seMethod not in StdErrors.methods + ('lazy',):
+            errorList.append("Standard errors method must be either 'hessian', 'opg', 'sandwich' or 'lazy'.")
+
+        if not self.starts > 0:
+            errorList.append('No. of starts must be greater than zero.')
+
+        if not self.startSD >= 0:
+            errorList.append('Standard deviation of the starting values must be non-negative.')
+
+        if self.startCutoff is not None and not self.startCutoff > 0:
+            errorList.append('Cutoff of the starts must be positive.')
+
+        if not (self.n_jobs > 0 or self.n_jobs == -1):
+            errorList.append('No. of jobs must be greater than zero, or -1 to use all cores.')
+
         # Whoever calls this validator knows that empty errorList means validator success
         return errorList
 
@@ -78,6 +158,22 @@ class ModelRouwendal:
         The VTT grid created with the specifications of `ConfigRouwendal`.
     vtt_mid : numpy.ndarray
         The mid points of the VTT grid.
+    stdErrors : StdErrors
+        Standard errors of the estimated parameters (logit of Q first), 
+        available after `run()`. Call `stdErrors(method)` to compute 
+        them with another method.
+    results : OptimizeResult
+        Result of the estimation routine, available after `run()`.
+    startEstimates : numpy.ndarray
+        Estimated parameters of each start (one row per start), available 
+        after `run()` with more than one start.
+    startLogLik : numpy.ndarray
+        Log-likelihood at the optimum of each start (NaN for abandoned 
+        starts), available after `run()` with more than one start.
+    timing : dict
+        Wall time in seconds of the optimisation (`'optimisation'`), of 
+        the Hessian and standard errors (`'hessian'`) and of the rest of 
+        the estimation (`'postprocessing'`), available after `run()`.
 
     Methods
     -------
@@ -108,10 +204,11 @@ class ModelRouwendal:
         dist = self.vtt_grid[1] - self.vtt_grid[0]
 
         # Print message of the support points
-        print("Created a VTT grid of " + str(self.cfg.supportPoints) + \
-            " points between " + str(self.cfg.minimum) + " and " + str(self.cfg.maximum) + ".")
+        if self.cfg.verbose:
+            print("Created a VTT grid of " + str(self.cfg.supportPoints) + \
+                " points between " + str(self.cfg.minimum) + " and " + str(self.cfg.maximum) + ".")
 
-        print("Distance between points of the VTT grid is " + str(dist))
+            print("Distance between points of the VTT grid is " + str(dist))
         
     def run(self):
         """Estimates the Rouwendal model.
@@ -130,9 +227,12 @@ class ModelRouwendal:
         q_prob : float
             The estimated probability of consistent choice.
         x : numpy.ndarray
-            The estimated density parameters at each point of the VTT grid.
+            The estimated density parameters at each point of the VTT grid, 
+            relative to the point with the highest density (whose parameter 
+            is zero).
         se : numpy.ndarray
-            The standard errors of `x`.
+            The standard errors of `x`. NaN at the point with the highest 
+            density, as its parameter is fixed.
         p : numpy.ndarray
             The estimates of the cumulative probability function (CDF) of 
             the VTT at each support point. The first point is always zero 
@@ -155,32 +255,51 @@ class ModelRouwendal:
         q0 = np.log(self.cfg.startQ/(1-self.cfg.startQ))
         x0 = np.hstack([q0, np.zeros(len(self.vtt_grid))])
 
-        # Get VTT grid shape
-        grid_shape = len(self.vtt_grid)
+        # Count the choices consistent with each point of the VTT grid (computed once per estimation)
+        tau = ModelRouwendal.consistentChoices(self.arrays.BVTT, self.arrays.Choice, self.vtt_grid)
+
+        # Collapse respondents with identical counts. The likelihood is evaluated once per unique pattern
+        tau, counts = np.unique(tau, axis=0, return_counts=True)
 
-        # Prepare arrays
-        BVTT_array = np.tile(self.arrays.BVTT,(grid_shape,1,1)).T
-        Choice_array = np.tile(self.arrays.Choice,(grid_shape,1,1)).T
+        if self.cfg.verbose:
+            print("Collapsed " + str(self.arrays.NP) + " respondents into " + str(tau.shape[0]) + " unique response patterns.")
 
         # Initial value of the log-likelihood function
-        init_ll = -ModelRouwendal.objectiveFunction(x0, self.arrays.NP, self.arrays.T, BVTT_array,
-                                                      Choice_array, self.vtt_grid)
+        init_ll = -ModelRouwendal.objectiveFunction(x0, self.arrays.T, tau, counts)
 
         # TODO: add an integrity check: initialVal should be finite. Otherwise, rise an error.
 
         # Starting values
-        argTuple = (self.arrays.NP, self.arrays.T, BVTT_array, Choice_array, self.vtt_grid)
+        argTuple = (self.arrays.T, tau, counts)
 
         # Start optimization
         t0 = time.time()
-        results = _bfgsmin(ModelRouwendal.objectiveFunction, x0, args=argTuple,tol=1e-6,verbose=True)
-
-        # Collect results
-        x = results['x']
-        hess = Hessian(ModelRouwendal.objectiveFunction,method='forward')(x,self.arrays.NP, self.arrays.T, BVTT_array, Choice_array, self.vtt_grid)
-        se = np.sqrt(np.diag(np.linalg.inv(hess)))
-        ll = -results['fun']
-        exitflag = results['convergence']
+        if self.cfg.starts > 1:
+            self.results, startResults, active = multistart(partial(ModelRouwendal._fit, self.cfg, argTuple), x0, self.cfg.starts, self.cfg.maxIterations,
+                                                            sd=self.cfg.startSD, seed=self.cfg.seed, n_jobs=self.cfg.n_jobs, cutoff=self.cfg.startCutoff)
+            self.startEstimates = np.array([r.x for r in startResults])
+            self.startLogLik = np.where(active, [-r.fun for r in startResults], np.nan)
+            if self.cfg.verbose:
+                print('Best of ' + str(self.cfg.starts) + ' starts. Log-likelihood of the optima between ' + \
+                    str(round(np.nanmin(self.startLogLik),2)) + ' and ' + str(round(np.nanmax(self.startLogLik),2)) + '.')
+        else:
+            self.results = ModelRouwendal._fit(self.cfg, argTuple, x0, self.cfg.maxIterations, verbose=self.cfg.verbose)
+        results = self.results
+        t_opt = time.time()
+
+        # Collect results. The density parameters are only identified up to a constant, so they are normalised 
+        # to zero at the point of the VTT grid with the highest density, whose parameter is fixed
+        x = results.x.copy()
+        ref = 1 + np.argmax(x[1:])
+        x[1:] = x[1:] - x[ref]
+        self.stdErrors = StdErrors(x, hessian=ModelRouwendal.hessian, scores=ModelRouwendal.scores, args=argTuple, weights=counts, fixed=[ref])
+        if self.cfg.seMethod == 'lazy':
+            se = np.full(len(x), np.nan)
+        else:
+            se = self.stdErrors(self.cfg.seMethod)
+        t_se = time.time()
+        ll = -results.fun
+        exitflag = results.convergence
 
         # Compute elapsed time
         t1 = time.time()
@@ -194,7 +313,7 @@ class ModelRouwendal:
         # Get estimated FVTT and xameters
         x = x[1:]
         se = se[1:]
-        fvtt = np.exp(x)/np.sum(np.exp(x))
+        fvtt = _softmax(x)
         p = np.cumsum(fvtt)
 
         # Compute the predicted VTT at the midpoints
@@ -203,29 +322,272 @@ class ModelRouwendal:
         # Add point 0 in the estimated CDF to make coincide with point zero in the VTT mid point
         p = np.concatenate((0,p),axis=None)
 
+        self.timing = {'optimisation': t_opt - t0, 'hessian': t_se - t_opt, 'postprocessing': time.time() - t_se}
+
         # Return output
         return q_est, q_se, q_prob, x, se, p, vtt, init_ll, ll, exitflag, est_time
 
     @staticmethod
-    def objectiveFunction(x, NP, T, BVTT, Choice, vtt_grid):
+    def _fit(cfg, argTuple, x0, maxiter, verbose=False):
+        if cfg.optimizer in ('em', 'squarem'):
+            t0 = time.time()
+            trace = _Trace(x0, cfg.callback)
+            results = ModelRouwendal.emAlgorithm(x0, *argTuple, accelerate=(cfg.optimizer == 'squarem'), maxiter=maxiter, tol=1e-6, verbose=verbose, callback=trace)
+            return OptimizeResult(x=results['x'], fun=results['fun'], iterations=results['iterations'], nfev=results['nfev'], njev=0,
+                                  wall_time=time.time()-t0, convergence=results['convergence'], method=cfg.optimizer, trace=trace.array())
+        else:
+            return minimize(ModelRouwendal.objectiveFunction, x0, method=cfg.optimizer, jac=ModelRouwendal.gradient, hess=ModelRouwendal.hessian,
+                            args=argTuple, maxiter=maxiter, tol=1e-6, verbose=verbose, callback=cfg.callback)
+
+    @staticmethod
+    def consistentChoices(BVTT, Choice, vtt_grid):
+        """Number of choices of each respondent that are consistent with each point of the VTT grid.
+
+        A choice is consistent with a VTT point if the fast-expensive 
+        alternative is chosen when the VTT point is greater than the BVTT, 
+        or the cheap-slow alternative is chosen otherwise. The counts do not 
+        depend on the model parameters, so they are computed once per 
+        estimation and without building (NP, T, G) arrays.
+
+        Parameters
+        ----------
+        BVTT : numpy.ndarray
+            The BVTT array, of shape (NP, T).
+        Choice : numpy.ndarray
+            The choice array, of shape (NP, T).
+        vtt_grid : numpy.ndarray
+            The (sorted) VTT grid, of length G.
+
+        Returns
+        -------
+        tau : numpy.ndarray
+            Integer array of shape (NP, G) with the number of consistent 
+            choices of each respondent at each point of the VTT grid.
+        """
+        NP = BVTT.shape[0]
+        G = len(vtt_grid)
+
+        # Position of each BVTT in the VTT grid: vtt_grid[g] > BVTT iff g >= pos
+        pos = np.searchsorted(vtt_grid, BVTT, side='right')
+
+        # Histogram of positions per respondent, separately for accepted and rejected choices
+        idx = np.arange(NP)[:, np.newaxis]*(G+1) + pos
+        accepts = np.bincount(idx[Choice], minlength=NP*(G+1)).reshape((NP, G+1))
+        rejects = np.bincount(idx[~Choice], minlength=NP*(G+1)).reshape((NP, G+1))
+
+        # Accepts with BVTT below each grid point plus rejects with BVTT at or above it
+        accepts_below = np.cumsum(accepts, axis=1)[:, :G]
+        rejects_above = rejects.sum(axis=1, keepdims=True) - np.cumsum(rejects, axis=1)[:, :G]
+        tau = accepts_below + rejects_above
+
+        return tau
+
+    @staticmethod
+    def emAlgorithm(x0, T, tau, counts, accelerate=False, maxiter=1000, tol=1e-6, verbose=False, callback=None):
+        """Maximises the log-likelihood function with the EM algorithm.
+
+        Each iteration computes the posterior probability of each point of 
+        the VTT grid for each respondent (E-step), and updates the density 
+        and the probability of consistent choice in closed form (M-step). 
+        If `accelerate=True`, the iterations are extrapolated with the 
+        SQUAREM scheme of Varadhan and Roland (2008).
+
+        Parameters
+        ----------
+        x0 : numpy.ndarray
+            Starting values, with the logit of Q in the first element and 
+            the density parameters in the rest.
+        T : int
+            Number of choice situations per respondent.
+        tau : numpy.ndarray
+            Number of consistent choices per response pattern and grid point.
+        counts : numpy.ndarray
+            Number of respondents with each response pattern.
+        accelerate : bool
+            Whether to use SQUAREM acceleration.
+        maxiter : int
+            Maximum number of iterations.
+        tol : float
+            Tolerance on the change of the log-likelihood between iterations.
+        verbose : bool
+            Whether to print the progress of the algorithm.
+        callback : callable, optional
+            Called at each iteration as `callback(x, f)`, with the 
+            parameters (in the same scale as `x0`) and the value of the 
+            objective function of the E-step.
+
+        Returns
+        -------
+        dict
+            Convergence flag, iterations, final value of the objective 
+            function and final value of the parameters (in the same scale 
+            as `x0`), as returned by `_bfgsmin`, and the number of EM steps 
+            (`nfev`), each of which evaluates the objective function.
+        """
+        # Parameters in probability scale: Q followed by the density at each grid point
+        theta = np.hstack([np.exp(x0[0]) / (1 + np.exp(x0[0])), _softmax(x0[1:])])
+        f_val = np.inf
+        convergence = 2
+        nfev = 0
+
+        if verbose:
+            print('Initial F-value: ' + str(round(ModelRouwendal.objectiveFunction(x0, T, tau, counts),2)))
+
+        for iter in range(maxiter):
+            f_old = f_val
+
+            # Plain EM iteration
+            theta1, f_val = ModelRouwendal.emStep(theta, T, tau, counts)
+            nfev += 1
+
+            if accelerate:
+                theta2, _ = ModelRouwendal.emStep(theta1, T, tau, counts)
+                nfev += 1
+
+                # Extrapolate with steplength alpha <= -1 (alpha = -1 gives theta2)
+                r = theta1 - theta
+                v = theta2 - theta1 - r
+                alpha = min(-np.sqrt(np.sum(r**2)/np.sum(v**2)), -1.) if np.sum(v**2) > 0 else -1.
+
+                # Shrink the step towards theta2 until the extrapolated point is feasible
+                while True:
+                    theta_sq = theta - 2*alpha*r + alpha**2*v
+                    if (alpha == -1.) or ((0 < theta_sq[0] < 1) and (theta_sq[1:] >= 0).all()):
+                        break
+                    alpha = min((alpha - 1)/2, -1.)
+
+                # Stabilise with an EM iteration and fall back to theta2 if the likelihood decreases
+                theta_new, f_sq = ModelRouwendal.emStep(theta_sq, T, tau, counts)
+                nfev += 1
+                if alpha != -1. and not (f_sq <= f_val):
+                    theta_new, _ = ModelRouwendal.emStep(theta2, T, tau, counts)
+                    nfev += 1
+            else:
+                theta_new = theta1
+
+            if callback is not None:
+                callback(np.hstack([np.log(theta[0]/(1-theta[0])), np.log(np.maximum(theta[1:], np.finfo(float).tiny))]), f_val)
+
+            theta = theta_new
+
+            if verbose:
+                print('Iter No. ' + str(int(iter+1)) + ': F-value: ' + str(round(f_val,2)) + ' / Change: ' + str(round(f_old-f_val,6)))
+
+            # If the change in the objective function is less than tolerance value, convergence is achieved
+            if np.abs(f_old - f_val) < tol:
+                convergence = 0
+
+                if verbose:
+                    print('\nLocal minimum found. Change in F-value below tolerance')
+
+                break
+
+        # Return parameters in the same scale as x0
+        x = np.hstack([np.log(theta[0]/(1-theta[0])), np.log(np.maximum(theta[1:], np.finfo(float).tiny))])
+        f_val = ModelRouwendal.objectiveFunction(x, T, tau, counts)
+
+        return({'convergence': convergence, 'iterations': iter+1, 'fun': f_val, 'x': x, 'nfev': nfev})
+
+    @staticmethod
+    def emStep(theta, T, tau, counts):
+        # Separate Q and FVTT
+        q = theta[0]
+        fvtt = theta[1:]
+
+        # E-step: posterior probability of each support point for each respondent
+        t = np.arange(T+1)
+        fP = fvtt*((q**t) * (1-q)**(T-t))[tau]
+        L = np.sum(fP, axis=1, keepdims=True)
+        w = fP / L
+
+        # M-step: density is the average posterior, Q is the share of consistent choices
+        fvtt_new = (counts @ w) / np.sum(counts)
+        q_new = (counts @ np.sum(w*tau, axis=1)) / (np.sum(counts)*T)
+
+        # Return updated parameters and the objective function at theta
+        return np.hstack([q_new, fvtt_new]), -(counts @ np.log(L[:,0]))
+
+    @staticmethod
+    def objectiveFunction(x, T, tau, counts):
         
         # Re-scale Q and FVTT to fit between zero and one
         q = np.exp(x[0]) / (1 + np.exp(x[0]))
-        fvtt = np.exp(x[1:]) / np.sum(np.exp(x[1:]))
+        fvtt = _softmax(x[1:])
 
-        # Compute conditional probabilities
-        tau = ((vtt_grid > BVTT) == Choice).astype(int).sum(axis=0)
-        P = ((q**tau) * (1-q)**(T-tau))
+        # Compute conditional probabilities (tau only takes the values 0,...,T)
+        t = np.arange(T+1)
+        P = ((q**t) * (1-q)**(T-t))[tau]
 
-        # Conditional probability
-        # P = np.zeros((NP, len(vtt_grid)))
-
-        # for n in range(len(vtt_grid)):
-        #     tau = np.sum(((vtt_grid[n] > BVTT) == Choice).astype(int), axis=1)
-        #     P[:, n] = (q**tau) * ((1-q) ** (T-tau))
-            
         # Maximise log-likelihood. L is computed by multiplying conditional P
-        # with density fvtt, average and sum across all obs
-        L = -np.sum(np.log(np.sum(fvtt*P, axis=1)))
+        # with density fvtt, average and sum across all obs (weighted by the no. of respondents per pattern)
+        L = -(counts @ np.log(np.sum(fvtt*P, axis=1)))
 
         return L
+
+    @staticmethod
+    def gradient(x, T, tau, counts):
+
+        # Re-scale Q and FVTT to fit between zero and one
+        q = np.exp(x[0]) / (1 + np.exp(x[0]))
+        fvtt = _softmax(x[1:])
+
+        # Compute conditional probabilities (tau only takes the values 0,...,T)
+        t = np.arange(T+1)
+        P = ((q**t) * (1-q)**(T-t))[tau]
+
+        # Posterior probability of each support point for each respondent
+        fP = fvtt*P
+        w = fP / np.sum(fP, axis=1, keepdims=True)
+
+        # Derivative w.r.t. the logit of Q: d log(P)/dx[0] = tau - T*q
+        g_q = -(counts @ np.sum(w*(tau - T*q), axis=1))
+
+        # Derivative w.r.t. the density parameters (softmax)
+        g_fvtt = -(counts @ w - np.sum(counts)*fvtt)
+
+        return np.hstack([g_q, g_fvtt])
+
+    @staticmethod
+    def scores(x, T, tau, counts):
+
+        # Re-scale Q and FVTT to fit between zero and one
+        q = np.exp(x[0]) / (1 + np.exp(x[0]))
+        fvtt = _softmax(x[1:])
+
+        # Posterior probability of each support point for each response pattern
+        t = np.arange(T+1)
+        fP = fvtt*((q**t) * (1-q)**(T-t))[tau]
+        w = fP / np.sum(fP, axis=1, keepdims=True)
+
+        # Gradient of the negative log-likelihood contribution of each response pattern
+        return -np.c_[np.sum(w*(tau - T*q), axis=1), w - fvtt]
+
+    @staticmethod
+    def hessian(x, T, tau, counts):
+
+        # Re-scale Q and FVTT to fit between zero and one
+        q = np.exp(x[0]) / (1 + np.exp(x[0]))
+        fvtt = _softmax(x[1:])
+        N = np.sum(counts)
+
+        # Posterior probability of each support point for each response pattern
+        t = np.arange(T+1)
+        fP = fvtt*((q**t) * (1-q)**(T-t))[tau]
+        w = fP / np.sum(fP, axis=1, keepdims=True)
+        cw = counts[:,np.newaxis]*w
+
+        # Scores of the logit of Q, by support point and by response pattern
+        d = tau - T*q
+        s_q = np.sum(w*d, axis=1)
+
+        # Second derivatives of the negative log-likelihood
+        h_qq = N*T*q*(1-q) - np.sum(cw*d**2) + counts @ s_q**2
+        h_qf = -np.sum(cw*(d - s_q[:,np.newaxis]), axis=0)
+        h_ff = N*(np.diag(fvtt) - np.outer(fvtt, fvtt)) - np.diag(np.sum(cw, axis=0)) + cw.T @ w
+
+        return np.block([[h_qq, h_qf], [h_qf[:,np.newaxis], h_ff]])
+
+# Density at the points of the VTT grid from its parameters, shifted by their maximum so exp does not overflow
+def _softmax(x):
+    e = np.exp(x - np.max(x))
+    return e / np.sum(e)
@@ -7,13 +7,13 @@
 #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """Modules to configure and estimate a Random Valuation model."""
 from dataclasses import dataclass
-from typing import Optional, Tuple
-from numdifftools import Hessian
+from functools import partial
+from typing import Callable, Optional, Tuple
 import numpy as np
 import time
 
 from py_np4vtt.data_format import ModelArrays
-from py_np4vtt.utils import _bfgsmin
+from py_np4vtt.utils import minimize, multistart, METHODS, StdErrors
 
 @dataclass
 class ConfigRV:
@@ -31,12 +31,55 @@ class ConfigRV:
         Starting value of the VTT parameter
     maxIterations : int
         Maximum number of iterations of the estimation routine.
+    seMethod : str
+        Method to compute the standard errors: `'hessian'` (default), 
+        `'opg'` (outer product of the scores per respondent) or 
+        `'sandwich'` (clustered by respondent). If `'lazy'`, the standard 
+        errors are not computed during the estimation and can be 
+        requested afterwards with `stdErrors`.
+    optimizer : str
+        Estimation routine: `'bfgs'` (default), `'lbfgs'`, `'newton'`, 
+        which uses the analytic Hessian of the log-likelihood function, 
+        `'L-BFGS-B'` or `'trust-exact'` (see `utils.minimize`).
+    starts : int
+        Number of starting values. The first one is the configured 
+        starting values, the others add normal draws with standard 
+        deviation `startSD`. The start with the highest log-likelihood is 
+        kept. Default is 1
+    startSD : float
+        Standard deviation of the draws of the starting values. Default 
+        is 1
+    startCutoff : Optional[float]
+        If given, starts whose log-likelihood is more than `startCutoff` 
+        below the best one after 10 iterations are abandoned.
+    seed : Optional[int]
+        Random seed of the starting values.
+    n_jobs : int
+        Number of worker processes that run the starts. `-1` uses all 
+        available cores. Default is 1
+    verbose : bool
+        Whether to print the progress of the estimation. Default is True
+    callback : Optional[Callable]
+        Called after each iteration of the estimation routine as 
+        `callback(iteration, x, fun, gnorm, step)` (see `utils.minimize`). 
+        With `n_jobs > 1`, it may run in the worker processes and must be 
+        picklable.
     """
     startScale: float
     startVTT: float
 
     maxIterations: int
 
+    seMethod: str = 'hessian'
+    optimizer: str = 'bfgs'
+    starts: int = 1
+    startSD: float = 1.
+    startCutoff: Optional[float] = None
+    seed: Optional[int] = None
+    n_jobs: int = 1
+    verbose: bool = True
+    callback: Optional[Callable] = None
+
     def validate(self):
         # Create errormessage list
         errorList = []
@@ -47,6 +90,24 @@ class ConfigRV:
         if not self.maxIterations > 0:
             errorList.append('Max iterations must be greater than zero.')
 
+        if self.seMethod not in StdErrors.methods + ('lazy',):
+            errorList.append("Standard errors method must be either 'hessian', 'opg', 'sandwich' or 'lazy'.")
+
+        if self.optimizer not in METHODS:
+            errorList.append('Optimizer must be one of ' + ', '.join("'" + m + "'" for m in METHODS) + '.')
+
+        if not self.starts > 0:
+            errorList.append('No. of starts must be greater than zero.')
+
+        if not self.startSD >= 0:
+            errorList.append('Standard deviation of the starting values must be non-negative.')
+
+        if self.startCutoff is not None and not self.startCutoff > 0:
+            errorList.append('Cutoff of the starts must be positive.')
+
+        if not (self.n_jobs > 0 or self.n_jobs == -1):
+            errorList.append('No. of jobs must be greater than zero, or -1 to use all cores.')
+
         # Whoever calls this validator knows that empty errorList means validator success
         return errorList
 
@@ -65,7 +126,22 @@ class ModelRV:
         
     Attributes
     ----------
-    None.
+    stdErrors : StdErrors
+        Standard errors of the estimated parameters, available after 
+        `run()`. Call `stdErrors(method)` to compute them with another 
+        method.
+    results : OptimizeResult
+        Result of the estimation routine, available after `run()`.
+    startEstimates : numpy.ndarray
+        Estimated parameters of each start (one row per start), available 
+        after `run()` with more than one start.
+    startLogLik : numpy.ndarray
+        Log-likelihood at the optimum of each start (NaN for abandoned 
+        starts), available after `run()` with more than one start.
+    timing : dict
+        Wall time in seconds of the optimisation (`'optimisation'`), of 
+        the Hessian and standard errors (`'hessian'`) and of the rest of 
+        the estimation (`'postprocessing'`), available after `run()`.
 
     References
     ----------
@@ -99,37 +175,75 @@ class ModelRV:
             optimisation succeeded. Otherwise, check the configuration parameters.
         est_time : float
             The estimation time in seconds.
+
+        Raises a ValueError if a BVTT is undefined (NaN), e.g. if both 
+        alternatives of a choice situation have equal costs and times.
         """
         # Set vector of starting values of parameters to estimate
         x0 = np.array([self.cfg.startScale, self.cfg.startVTT])
 
         BVTT=self.arrays.BVTT.flatten()
         y_regress=self.arrays.Choice.flatten()
+        if np.any(np.isnan(BVTT)):
+            raise ValueError('Undefined BVTT in ' + str(np.sum(np.isnan(BVTT))) + ' choice situation(s). Remove them from the data.')
+
+        # Respondent of each choice situation. Unbalanced panels have one row per choice situation, so use their participant IDs
+        if self.arrays.RowID is None:
+            respondent = np.arange(self.arrays.BVTT.shape[0])
+        else:
+            respondent = np.unique(self.arrays.RowID, return_inverse=True)[1].ravel()
+        clusters=np.repeat(respondent, self.arrays.BVTT.shape[1])
 
-        init_ll = -ModelRV.objectiveFunction(x0, BVTT, y_regress)
+        # The likelihood only depends on the number of observations of each (BVTT, choice) pair
+        pairs, counts = np.unique(np.c_[BVTT, y_regress], axis=0, return_counts=True)
 
         # Starting arguments and values for minimizer
-        argTuple = (BVTT, y_regress)
+        argTuple = (pairs[:,0], pairs[:,1], counts)
+
+        init_ll = -ModelRV.objectiveFunction(x0, *argTuple)
 
         # Start minimization routine
         t0 = time.time()
-        results = _bfgsmin(ModelRV.objectiveFunction, x0, args=argTuple, tol=1e-6,maxiter=self.cfg.maxIterations,verbose=True)
+        if self.cfg.starts > 1:
+            self.results, startResults, active = multistart(partial(ModelRV._fit, self.cfg, argTuple), x0, self.cfg.starts, self.cfg.maxIterations,
+                                                            sd=self.cfg.startSD, seed=self.cfg.seed, n_jobs=self.cfg.n_jobs, cutoff=self.cfg.startCutoff)
+            self.startEstimates = np.array([r.x for r in startResults])
+            self.startLogLik = np.where(active, [-r.fun for r in startResults], np.nan)
+            if self.cfg.verbose:
+                print('Best of ' + str(self.cfg.starts) + ' starts. Log-likelihood of the optima between ' + \
+                    str(round(np.nanmin(self.startLogLik),2)) + ' and ' + str(round(np.nanmax(self.startLogLik),2)) + '.')
+        else:
+            self.results = ModelRV._fit(self.cfg, argTuple, x0, self.cfg.maxIterations, verbose=self.cfg.verbose)
+        results = self.results
 
         # Compute elapsed time
         t1 = time.time()
         est_time = t1 - t0
+        t_opt = t1
 
         # Collect results
-        x = results['x']
-        hess = Hessian(ModelRV.objectiveFunction,method='forward')(x, BVTT, y_regress)
-        se = np.sqrt(np.diag(np.linalg.inv(hess)))
-        ll = -results['fun']
-        exitflag = results['convergence']
+        x = results.x
+        # The scores are clustered per respondent, so they use the uncompressed data. The Hessian uses the unique pairs
+        self.stdErrors = StdErrors(x, hessian=ModelRV.hessian, scores=ModelRV.scores, args=(BVTT, y_regress), clusters=clusters, hessianArgs=argTuple)
+        if self.cfg.seMethod == 'lazy':
+            se = np.full(len(x), np.nan)
+        else:
+            se = self.stdErrors(self.cfg.seMethod)
+        t_se = time.time()
+        ll = -results.fun
+        exitflag = results.convergence
+
+        self.timing = {'optimisation': t_opt - t0, 'hessian': t_se - t_opt, 'postprocessing': time.time() - t_se}
 
         return x, se, init_ll, ll, exitflag, est_time
 
     @staticmethod
-    def objectiveFunction(x: np.ndarray, BVTT: np.ndarray, y_regress: np.ndarray):
+    def _fit(cfg, argTuple, x0, maxiter, verbose=False):
+        return minimize(ModelRV.objectiveFunction, x0, method=cfg.optimizer, jac=ModelRV.gradient, hess=ModelRV.hessian,
+                        args=argTuple, maxiter=maxiter, tol=1e-6, verbose=verbose, callback=cfg.callback)
+
+    @staticmethod
+    def objectiveFunction(x: np.ndarray, BVTT: np.ndarray, y_regress: np.ndarray, counts: Optional[np.ndarray] = None):
         # Separate parameters: x is the estimated (multi-dimensional) parameter
         scale, VTT = x
 
@@ -138,12 +252,50 @@ class ModelRV:
         V2 = scale * VTT
 
         dV = V2 - V1
-        # dV[dV>700] = 700
 
-        # Create choice probability and Log-likelihood
-        p = 1 / (1 + np.exp(-dV))
-        ll_n = (1-y_regress) * np.log(1-p) + y_regress*np.log(p)
+        # Log-likelihood, with the choice probability p = 1/(1+exp(-dV)) and a stable log-sigmoid
+        ll_n = -np.logaddexp(0., np.where(y_regress == 1, -dV, dV))
+        if counts is not None:
+            ll_n = counts * ll_n
         ll = - np.sum(ll_n)
 
         # Return choice probability
-        return ll
\ No newline at end of file
+        return ll
+
+    @staticmethod
+    def gradient(x: np.ndarray, BVTT: np.ndarray, y_regress: np.ndarray, counts: Optional[np.ndarray] = None):
+        s = ModelRV.scores(x, BVTT, y_regress)
+        if counts is not None:
+            s = counts[:,np.newaxis] * s
+        return np.sum(s, axis=0)
+
+    @staticmethod
+    def hessian(x: np.ndarray, BVTT: np.ndarray, y_regress: np.ndarray, counts: Optional[np.ndarray] = None):
+        # Separate parameters: x is the estimated (multi-dimensional) parameter
+        scale, VTT = x
+        w = np.ones(len(BVTT)) if counts is None else counts
+
+        # Choice probability
+        dV = scale * (VTT - BVTT)
+        with np.errstate(over='ignore'):
+            p = 1 / (1 + np.exp(-dV))
+
+        # Gauss-Newton term with the derivatives of dV, plus the second derivative of dV (scale with VTT)
+        J = np.c_[VTT - BVTT, np.full(len(BVTT), scale)]
+        H = (J * (w*p*(1-p))[:,np.newaxis]).T @ J
+        H[0,1] = H[1,0] = H[0,1] - np.sum(w*(y_regress - p))
+
+        return H
+
+    @staticmethod
+    def scores(x: np.ndarray, BVTT: np.ndarray, y_regress: np.ndarray):
+        # Separate parameters: x is the estimated (multi-dimensional) parameter
+        scale, VTT = x
+
+        # Choice probability
+        dV = scale * (VTT - BVTT)
+        with np.errstate(over='ignore'):
+            p = 1 / (1 + np.exp(-dV))
+
+        # Gradient of the negative log-likelihood of each choice
+        return -(y_regress - p)[:,np.newaxis] * np.c_[VTT - BVTT, np.full(len(BVTT), scale)]
@@ -6,7 +6,14 @@
 #
 #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 import numpy as np
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from functools import partial
+from typing import Optional
 from random import uniform
+from scipy.optimize import minimize as scipy_minimize
 
 # Create VTT midpoints
 def vtt_midpoints(vtt_grid):
@@ -36,123 +43,597 @@ def predicted_vtt(ecdf,grid,NP):
 import numpy as np
 
 # BFGS Minimizer function
-def _bfgsmin(f,x0,maxiter=1000,tol=np.sqrt(np.finfo(float).eps),verbose=False,difftype='central',diffeps=np.sqrt(np.finfo(float).eps),steptol=1e-30,args=()):
+def _bfgsmin(f,x0,maxiter=1000,tol=np.sqrt(np.finfo(float).eps),verbose=False,difftype='central',diffeps=np.sqrt(np.finfo(float).eps),steptol=1e-30,args=(),jac=None,memory=None,executor=None,callback=None,gtol=None):
+    """Minimizes `f` with the BFGS algorithm and a Wolfe line search.
+
+    The approximation of the inverse Hessian is updated directly, so each 
+    iteration costs O(K^2) operations. If `memory` is given, the limited 
+    memory variant (L-BFGS) keeps only the last `memory` updates, with 
+    O(K*memory) operations per iteration. The gradient is `jac` if given, 
+    or a numerical gradient otherwise, which evaluates the perturbed 
+    parameters in one call if `f` is `vectorized`, or concurrently in 
+    `executor` if given. If `callback` is given, it is called as 
+    `callback(x, f, g)` after each iteration.
+
+    The algorithm converges when the quasi-Newton decrement is below `tol` 
+    and the largest absolute element of the gradient is below `gtol` 
+    (default `sqrt(tol)`). If only the decrement is small, a steepest 
+    descent step checks the approximation of the inverse Hessian, and the 
+    algorithm converges if that step decreases `f` by less than `tol`. 
+    Steepest descent steps start with unit length, and the approximation 
+    is scaled with the curvature of the first step after a (re)start.
+
+    Returns a dict with the convergence flag (0: converged, 2: maximum 
+    iterations reached, 5: step size tolerance reached), the number of 
+    iterations (steps taken), and the final value of `f`, `x` and the 
+    approximate Hessian (None with L-BFGS).
+    """
+    if gtol is None:
+        gtol = np.sqrt(tol)
+
+    # If no analytic gradient is passed, use numeric gradient
+    if jac is None:
+        jac = lambda x, *args: _numgr(f,x,difftype,diffeps,*args,executor=executor)
+
+    with np.errstate(all='ignore'):
+
+        # Initialize parameters
+        x = np.array(x0, dtype=float)               # Initial value of x
+        f_val = f(x,*args)                          # Initial value for objective function
+        g0 = jac(x,*args)                           # Initial value of gradient
+        Hinv = np.eye(x.shape[0])                   # Initial value of the approximate inverse Hessian (BFGS)
+        s_list, y_list = [], []                     # Last updates of x and of the gradient (L-BFGS)
+        restart = True                              # Whether the approximation is the (unscaled) identity matrix
+        check_gain = np.inf                         # Decrease of f in the last steepest descent check step
+        iterations = 0                              # Number of steps taken
+        convergence = 2                             # Set convergence flag to 2 (max. iterations). If zero, the algorithm converged
+
+        # Print inital value of the objective function
+        if verbose:
+            print('Initial F-value: ' + str(round(f_val,2)))
+
+        # Start algorithm
+        for _ in range(maxiter):
+
+            # Construct direction vector
+            if memory is None:
+                d = -Hinv @ g0
+            else:
+                d = -_lbfgs_direction(g0,s_list,y_list)
+            m = d.T @ g0
 
+            # If the (quasi-Newton) decrement and the gradient are less than tolerance values, convergence is achieved and the loop is broken
+            small = np.abs(m) < tol
+            if small and (np.max(np.abs(g0)) < gtol or check_gain < tol):
+                convergence = 0
 
-    # Ignore warnings
-    import warnings
-    warnings.filterwarnings("ignore")
+                if verbose:
+                    print('\nLocal minimum found. G-norm below tolerance')
+
+                break
+
+            # If the direction is not a descent direction, restart from the steepest descent direction
+            if not m < 0:
+                Hinv = np.eye(x.shape[0])
+                s_list, y_list = [], []
+                restart = True
+
+            # If the decrement is small but the gradient is not, check with a steepest descent step and keep the approximation, which is corrected by the update
+            check = small and not restart
+            if restart or small:
+                d = -g0
+                m = d.T @ g0
+
+            # Select a step size that satisfies the Wolfe conditions. Steepest descent steps start with unit length
+            a0 = min(1., 1./np.linalg.norm(d)) if restart or small else 1.
+            lambd, x1, f1, g1 = _wolfe_search(f,jac,x,d,f_val,g0,args,steptol,a0=a0)
+
+            # If no step size decreases the objective function, stop and return convergence = 5
+            if lambd is None:
+                if verbose:
+                    print('\nLocal minimum possible. Step size tolerance limit reached.')
+                convergence = 5
+                break
+
+            check_gain = f_val - f1 if check else np.inf
+
+            # BFGS ALGORITHM: construct the improvement and gradient improvement
+            s0 = x1 - x
+            y0 = g1 - g0
+            sy = y0 @ s0
+
+            # Update the inverse Hessian using the BFGS formula (only if the curvature condition holds)
+            if sy > 0:
+                if memory is None:
+                    # Scale the identity matrix with the curvature of the first step after a (re)start
+                    if restart:
+                        Hinv = (sy/(y0 @ y0)) * np.eye(x.shape[0])
+                        restart = False
+                    Hy = Hinv @ y0
+                    Hinv = Hinv + ((sy + y0 @ Hy)/sy**2) * np.outer(s0,s0) - (np.outer(Hy,s0) + np.outer(s0,Hy))/sy
+                else:
+                    restart = False
+                    s_list.append(s0)
+                    y_list.append(y0)
+                    if len(s_list) > memory:
+                        s_list.pop(0)
+                        y_list.pop(0)
+
+            # Store new gradient and compute the new value of objective function
+            x = x1
+            g0 = g1
+            f_val = f1
+            iterations += 1
+
+            if callback is not None:
+                callback(x, f_val, g0)
+
+            # Print output
+            if verbose:
+                print('Iter No. ' + str(iterations) + ': F-value: ' + str(round(f_val,2)) + ' / Step size: ' + str(round(lambd,6)) + ' / G-norm: ' + str(round(np.abs(m),6)))
+
+        # Return the Hessian approximation
+        H = np.linalg.inv(Hinv) if memory is None else None
+
+    # Return convergence flag, iterations, final f value, final x value, and final approx. hessian
+    return({'convergence': convergence, 'iterations': iterations, 'fun': f_val, 'x': x, 'hessian': H})
+
+# Direction -Hinv @ g of L-BFGS, with the two-loop recursion
+def _lbfgs_direction(g,s_list,y_list):
+    q = g.copy()
+    alpha = []
+    for s, y in zip(reversed(s_list),reversed(y_list)):
+        a = (s @ q)/(y @ s)
+        q = q - a*y
+        alpha.append(a)
+
+    # Scale of the initial approximation from the last update
+    if s_list:
+        q = q * (s_list[-1] @ y_list[-1])/(y_list[-1] @ y_list[-1])
+
+    for (s, y), a in zip(zip(s_list,y_list),reversed(alpha)):
+        b = (y @ q)/(y @ s)
+        q = q + (a-b)*s
+
+    return q
+
+# Line search for a step size that satisfies the strong Wolfe conditions
+def _wolfe_search(f,jac,x,d,f0,g0,args,steptol=1e-30,c1=1e-4,c2=0.9,maxiter=50,a0=1.):
+    # The gradient is only evaluated at steps with sufficient decrease of f, and the accepted step returns 
+    # its function and gradient values, so they are not computed again
+    dphi0 = d @ g0
+
+    def armijo(a, f1):
+        return np.isfinite(f1) and (f1 <= f0 + c1*a*dphi0)
+
+    def zoom(lo, f_lo, dphi_lo, x_lo, g_lo, hi, f_hi):
+        for _ in range(maxiter):
+            # Minimum of the quadratic interpolation, kept within the interval
+            width = hi - lo
+            a = lo + width/2
+            if np.isfinite(f_hi):
+                denom = 2*(f_hi - f_lo - dphi_lo*width)
+                if denom > 0:
+                    a = lo - dphi_lo*width**2/denom
+            if not (min(lo,hi) + 0.1*abs(width) <= a <= max(lo,hi) - 0.1*abs(width)):
+                a = lo + width/2
+            if abs(width) < steptol:
+                break
+
+            x1 = x + a*d
+            f1 = f(x1,*args)
+            if not armijo(a, f1) or f1 >= f_lo:
+                hi, f_hi = a, f1
+            else:
+                g1 = jac(x1,*args)
+                dphi1 = d @ g1
+                if np.abs(dphi1) <= -c2*dphi0:
+                    return a, x1, f1, g1
+                if dphi1*(hi - lo) >= 0:
+                    hi, f_hi = lo, f_lo
+                lo, f_lo, dphi_lo, x_lo, g_lo = a, f1, dphi1, x1, g1
+
+        # Return the best step with sufficient decrease, if any
+        if lo > 0:
+            return lo, x_lo, f_lo, g_lo
+        return None, None, None, None
+
+    a_prev, f_prev, dphi_prev, x_prev, g_prev = 0., f0, dphi0, x, g0
+    a = a0
+    for i in range(maxiter):
+        x1 = x + a*d
+        f1 = f(x1,*args)
+        if not armijo(a, f1) or (i > 0 and f1 >= f_prev):
+            return zoom(a_prev, f_prev, dphi_prev, x_prev, g_prev, a, f1)
+
+        g1 = jac(x1,*args)
+        dphi1 = d @ g1
+        if np.abs(dphi1) <= -c2*dphi0:
+            return a, x1, f1, g1
+        if dphi1 >= 0:
+            return zoom(a, f1, dphi1, x1, g1, a_prev, f_prev)
+
+        a_prev, f_prev, dphi_prev, x_prev, g_prev = a, f1, dphi1, x1, g1
+        a = 2*a
+
+    return a_prev, x_prev, f_prev, g_prev
+
+# Newton minimizer function, for objective functions with analytic gradient and Hessian
+def _newton(f,x0,jac,hess,maxiter=100,tol=np.sqrt(np.finfo(float).eps),verbose=False,steptol=1e-30,args=(),callback=None):
 
     # Initialize parameters
-    x = np.array(x0)                            # Initial value of x
+    x = np.array(x0, dtype=float)               # Initial value of x
     f_val = f(x,*args)                          # Initial value for objective function
-    g0 = _numgr(f,x,difftype,diffeps,*args)      # Initial value of gradient
-    H0 = np.eye(x.shape[0])                     # Initial value of approximate Hessian is a positive definite matrix (e.g. identity matrix)
-    g_diff = np.inf                             # Initial difference in gradient norm is set to infinity
+    g0 = jac(x,*args)                           # Initial value of gradient
     c1 = 1e-4                                   # Internal scalar for the Armijo-Goldstein condition (for step size computation)
-    lambd = 1                                   # Initial value of the step size
-    convergence = -1                            # Set convergence flag to -1. If zero, the algorithm converged
+    iterations = 0                              # Number of steps taken
+    convergence = 2                             # Set convergence flag to 2 (max. iterations). If zero, the algorithm converged
 
     # Print inital value of the objective function
     if verbose:
         print('Initial F-value: ' + str(round(f_val,2)))
 
     # Start algorithm
-    for iter in range(maxiter):
-        
-        # If gradient norm is less than tolerance value, convergence is achieved and the loop is broken
-        if g_diff < tol:
+    for _ in range(maxiter):
+
+        # Newton direction
+        H0 = hess(x,*args)
+        try:
+            d = -np.linalg.solve(H0,g0)
+        except np.linalg.LinAlgError:
+            d = -np.linalg.pinv(H0,hermitian=True) @ g0
+        m = d.T @ g0
+
+        # If the Hessian is not positive definite, use the steepest descent direction
+        if not m < 0:
+            d = -g0
+            m = d.T @ g0
+
+        # If the Newton decrement is less than tolerance value, convergence is achieved and the loop is broken
+        if np.abs(m) < tol:
             convergence = 0
 
             if verbose:
-                print('\nLocal minimum found. G-norm below tolerance')
+                print('\nLocal minimum found. Newton decrement below tolerance')
 
             break
 
-        # Set step size = 1 on each new iteration
-        lambd = 1
-
-        # Construct direction vector and relative gradient
-
-        # d = np.linalg.solve(-H0,np.eye(len(x))) @ g0
-        d = np.linalg.inv(-H0) @ g0
-        m = d.T @ g0
         # Select step size that satisfies the Armijo-Goldstein condition
+        lambd = 1
         while True:
-            
-            # If lambd decreases less than tol, then stop and return convergence = 3
+
+            # If lambd decreases less than tol, then stop and return convergence = 5
             if lambd < steptol:
                 if verbose:
                     print('\nLocal minimum possible. Step size tolerance limit reached.')
                 convergence = 5
                 break
 
-            # Evaluate objective function using current step size
             x1 = x + lambd*d
             f1 = f(x1,*args)
-
-            # Construct test for A-G condition
-            ftest = f_val + c1*lambd*m
-
-            # If A-G condition is satisfied (i.e current step size generates a decrease of the objective function), continue with BFGS algorithm
-            if (np.isnan(f1) == False) and (f1 <= ftest) and (f1 > 0):
+            if np.isfinite(f1) and (f1 <= f_val + c1*lambd*m):
                 break
+            lambd = lambd/2
 
-            # ...else, decrease step size
-            else:
-                lambd = lambd/2
-
-        # If step size calculation loop was broken, then break the algorithm and return convergence code + partial results
         if convergence == 5:
             break
 
-        # BFGS ALGORITHM: construct the improvement and gradient improvement
-        g1 = _numgr(f,x1,difftype,diffeps,*args)
-        s0 = (lambd*d)[:,np.newaxis]
-        y0 = (g1 - g0)[:,np.newaxis]
-
-        # Update Hessian using BFGS formula
-        H0 = H0 + (y0 @ y0.T) / (y0.T @ s0) - (((H0 @ s0) @ s0.T) @ H0)/((s0.T @ H0) @ s0)
-        
-        # Store new gradient and compute the new value of objective function
-        x = x1.copy()
-        g0 = g1.copy()
-        f_val = f1.copy()
-
-        # Compute infinite norm of gradient vector 
-        g_diff = np.abs(m)
-        # Print output
-        if verbose:
-            print('Iter No. ' + str(int(iter+1)) + ': F-value: ' + str(round(f_val,2)) + ' / Step size: ' + str(round(lambd,6)) + ' / G-norm: ' + str(round(g_diff,6)))
-
-    # If the algorithm reaches the maximum iterations, it prints convergence message = 2
-    if iter == maxiter:
-        convergence = 2
+        x = x1
+        f_val = f1
+        g0 = jac(x,*args)
+        iterations += 1
 
-    # Return the Hessian approximation
-    H = H0
+        if callback is not None:
+            callback(x, f_val, g0)
 
-    # Return convergence flag, iterations, final f value, final x value, and final approx. hessian
-    return({'convergence': convergence, 'iterations': iter+1, 'fun': f_val, 'x': x, 'hessian': H})
+        # Print output
+        if verbose:
+            print('Iter No. ' + str(iterations) + ': F-value: ' + str(round(f_val,2)) + ' / Step size: ' + str(round(lambd,6)) + ' / Decrement: ' + str(round(np.abs(m),6)))
+
+    # Return convergence flag, iterations, final f value, final x value, and final hessian
+    return({'convergence': convergence, 'iterations': iterations, 'fun': f_val, 'x': x, 'hessian': hess(x,*args)})
+
+# Result of an optimisation routine
+@dataclass
+class OptimizeResult:
+    """Result of `minimize`, common to all optimisation routines.
+
+    Attributes
+    ----------
+    x : numpy.ndarray
+        The parameters at the optimum.
+    fun : float
+        The value of the objective function at the optimum.
+    iterations : int
+        Number of iterations.
+    nfev : int
+        Number of evaluations of the objective function (including those 
+        of numerical gradients).
+    njev : int
+        Number of evaluations of the gradient.
+    wall_time : float
+        Time spent in the optimisation routine, in seconds.
+    convergence : int
+        Convergence flag: 0 if the routine converged, 2 if the maximum 
+        number of iterations was reached, 5 if the routine stopped without 
+        further progress (e.g. step size tolerance).
+    method : str
+        The optimisation routine.
+    hessian : numpy.ndarray, optional
+        The (approximate) Hessian at the optimum, if the routine computes it.
+    nhev : int
+        Number of evaluations of the Hessian.
+    trace : numpy.ndarray, optional
+        One row per iteration with the value of the objective function, 
+        the norm of the gradient (NaN if not available) and the norm of 
+        the step.
+    """
+    x: np.ndarray
+    fun: float
+    iterations: int
+    nfev: int
+    njev: int
+    wall_time: float
+    convergence: int
+    method: str
+    hessian: Optional[np.ndarray] = None
+    nhev: int = 0
+    trace: Optional[np.ndarray] = None
+
+# Trace of the iterations of an optimisation routine
+class _Trace:
+    """Records the value of the objective function, the gradient norm and 
+    the step norm of each iteration, and passes them to `callback` as 
+    `callback(iteration, x, fun, gnorm, step)`."""
+    def __init__(self, x0, callback=None):
+        self.x = np.array(x0, dtype=float)
+        self.callback = callback
+        self.rows = []
+
+    def __call__(self, x, f, g=None):
+        gnorm = np.nan if g is None else np.linalg.norm(g)
+        step = np.linalg.norm(x - self.x)
+        self.x = np.array(x, dtype=float)
+        self.rows.append((f, gnorm, step))
+        if self.callback is not None:
+            self.callback(len(self.rows), self.x, f, gnorm, step)
+
+    def array(self):
+        return np.array(self.rows).reshape(-1, 3)
+
+# Optimisation routines of minimize
+METHODS = ('bfgs', 'lbfgs', 'newton', 'L-BFGS-B', 'trust-exact')
+
+# Minimizer with selectable optimisation routine
+def minimize(f,x0,method='bfgs',jac=None,hess=None,args=(),maxiter=1000,tol=1e-6,verbose=False,callback=None,executor=None):
+    """Minimizes `f` with one of several optimisation routines.
+
+    Parameters
+    ----------
+    f : callable
+        The objective function, `f(x, *args)`.
+    x0 : numpy.ndarray
+        Starting values.
+    method : str
+        `'bfgs'` (built-in BFGS), `'lbfgs'` (built-in limited-memory BFGS), 
+        `'newton'` (built-in Newton, requires `jac` and `hess`), 
+        `'L-BFGS-B'` or `'trust-exact'` (scipy, the latter requires `hess`).
+    jac : callable, optional
+        Gradient of `f`. If None, a numerical gradient is used.
+    hess : callable, optional
+        Hessian of `f`.
+    args : tuple
+        Extra arguments of `f`, `jac` and `hess`.
+    maxiter : int
+        Maximum number of iterations.
+    tol : float
+        Convergence tolerance.
+    verbose : bool
+        Print the progress of the built-in routines.
+    callback : callable, optional
+        Called after each iteration as `callback(iteration, x, fun, gnorm, 
+        step)`, with the value of the objective function, the norm of the 
+        gradient and the norm of the step.
+    executor : concurrent.futures.Executor, optional
+        If given, the numerical gradient of the built-in routines (`jac` 
+        is None) evaluates the perturbed parameters concurrently in it. 
+        With a process pool, `f` must be picklable.
+
+    Returns
+    -------
+    OptimizeResult
+        The result of the optimisation.
+    """
+    if method not in METHODS:
+        raise ValueError('method must be one of ' + ', '.join("'" + m + "'" for m in METHODS))
+    if method in ('newton', 'trust-exact') and (jac is None or hess is None):
+        raise ValueError("method '" + method + "' requires the gradient and the Hessian")
+
+    # Count the evaluations of the objective function, the gradient and the Hessian, and keep the last ones for the trace
+    counts = {'f': 0, 'g': 0, 'h': 0}
+    last = {}
+
+    def f_count(x,*args):
+        if np.ndim(x) == 2:
+            counts['f'] += x.shape[0]
+            return f(x,*args)
+        counts['f'] += 1
+        last['f'] = (np.copy(x), f(x,*args))
+        return last['f'][1]
+    f_count.vectorized = getattr(f,'vectorized',False)
+
+    # The built-in routines use a central numerical gradient if no gradient is given. The 
+    # executor evaluates `f` itself, as the counting wrapper cannot be sent to other processes
+    def numerical_gradient(x,*args):
+        if executor is None:
+            return _numgr(f_count,x,'central',np.sqrt(np.finfo(float).eps),*args)
+        counts['f'] += 2*len(x)
+        return _numgr(f,x,'central',np.sqrt(np.finfo(float).eps),*args,executor=executor)
+
+    gradient = numerical_gradient if jac is None and method in ('bfgs', 'lbfgs') else jac
+
+    # scipy evaluates the gradient after the callback, which already needs it for the trace
+    def jac_count(x,*args):
+        if 'g' in last and np.array_equal(last['g'][0], x):
+            return last['g'][1]
+        counts['g'] += 1
+        last['g'] = (np.copy(x), gradient(x,*args))
+        return last['g'][1]
+
+    def hess_count(x,*args):
+        counts['h'] += 1
+        return hess(x,*args)
+
+    trace = _Trace(x0, callback)
+
+    # scipy only passes x to the callback: reuse the last evaluations at x if possible. After 
+    # a rejected step of trust-exact, x is the previous iterate, whose value is in the trace
+    def scipy_callback(x):
+        if 'f' in last and np.array_equal(last['f'][0], x):
+            f_x = last['f'][1]
+        elif trace.rows and np.array_equal(trace.x, x):
+            f_x = trace.rows[-1][0]
+        else:
+            f_x = f(x,*args)
+        trace(x, f_x, None if jac is None else jac_count(x,*args))
+
+    t0 = time.time()
+    if method in ('bfgs', 'lbfgs'):
+        results = _bfgsmin(f_count,x0,args=args,tol=tol,maxiter=maxiter,verbose=verbose,
+                           jac=jac_count,memory=10 if method == 'lbfgs' else None,callback=trace)
+        x, fun, iterations, convergence, H = results['x'], results['fun'], results['iterations'], results['convergence'], results['hessian']
+    elif method == 'newton':
+        results = _newton(f_count,x0,jac_count,hess_count,args=args,tol=tol,maxiter=maxiter,verbose=verbose,callback=trace)
+        x, fun, iterations, convergence, H = results['x'], results['fun'], results['iterations'], results['convergence'], results['hessian']
+    else:
+        # Tolerance on the gradient as in the built-in routines, which also stop when the largest gradient element is below sqrt(tol)
+        results = scipy_minimize(f_count,x0,args=args,method=method,jac=None if jac is None else jac_count,
+                                 hess=hess_count if method == 'trust-exact' else None,options={'maxiter': maxiter, 'gtol': np.sqrt(tol)},
+                                 callback=scipy_callback)
+        x, fun, iterations = results.x, results.fun, results.nit
+        convergence = 0 if results.success else (2 if iterations >= maxiter else 5)
+        H = hess_count(x,*args) if method == 'trust-exact' else None
+        if verbose:
+            print('\n' + str(results.message))
+
+    return OptimizeResult(x=x, fun=float(fun), iterations=int(iterations), nfev=counts['f'], njev=counts['g'],
+                          wall_time=time.time()-t0, convergence=int(convergence), method=method, hessian=H,
+                          nhev=counts['h'], trace=trace.array())
+
+# Estimation from several starting values
+def multistart(fit,x0,starts,maxiter,sd=1.,seed=None,n_jobs=1,cutoff=None,cutoffIterations=10):
+    """Runs an estimation routine from several starting values.
+
+    The first start is `x0`. The others add normal draws with standard 
+    deviation `sd` to `x0`. If `cutoff` is given, all starts first run 
+    `cutoffIterations` iterations, and only those whose objective function 
+    is within `cutoff` of the best one continue, from where they stopped.
+
+    Parameters
+    ----------
+    fit : callable
+        The estimation routine, `fit(x0, maxiter)`, which returns an 
+        `OptimizeResult`. With `n_jobs > 1` it must be picklable, e.g. a 
+        `functools.partial` of a static method.
+    x0 : numpy.ndarray
+        Starting values of the first start.
+    starts : int
+        Number of starts.
+    maxiter : int
+        Maximum number of iterations of each start.
+    sd : float
+        Standard deviation of the draws added to `x0`.
+    seed : int, optional
+        Random seed of the draws.
+    n_jobs : int
+        Number of worker processes. `-1` uses all available cores.
+    cutoff : float, optional
+        Starts whose objective function exceeds the best one by more than 
+        `cutoff` after `cutoffIterations` iterations are abandoned.
+    cutoffIterations : int
+        Number of iterations before the cutoff.
+
+    Returns
+    -------
+    best : OptimizeResult
+        The result of the start with the lowest objective function.
+    results : list
+        The result of each start. Abandoned starts keep the result at 
+        the cutoff.
+    active : numpy.ndarray
+        False for the abandoned starts.
+    """
+    rng = np.random.default_rng(seed)
+    x_start = x0 + sd*rng.standard_normal((starts,len(x0)))
+    x_start[0] = x0
+
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    n_jobs = min(n_jobs, starts)
+    executor = ProcessPoolExecutor(n_jobs) if n_jobs > 1 else None
+    fitAll = lambda x, m: list(executor.map(fit, x, m) if executor else map(fit, x, m))
+
+    try:
+        active = np.ones(starts, dtype=bool)
+        if cutoff is None or cutoffIterations >= maxiter:
+            results = fitAll(x_start, [maxiter]*starts)
+        else:
+            results = fitAll(x_start, [cutoffIterations]*starts)
+
+            # Abandon the dominated starts and continue those that did not converge yet
+            fun = np.array([r.fun for r in results])
+            active = np.isfinite(fun) & (fun <= np.nanmin(fun) + cutoff)
+            resume = [i for i in range(starts) if active[i] and results[i].convergence == 2]
+            for i, r in zip(resume, fitAll([results[i].x for i in resume], [maxiter - results[i].iterations for i in resume])):
+                results[i] = replace(r, iterations=results[i].iterations + r.iterations, nfev=results[i].nfev + r.nfev,
+                                     njev=results[i].njev + r.njev, nhev=results[i].nhev + r.nhev,
+                                     wall_time=results[i].wall_time + r.wall_time,
+                                     trace=None if r.trace is None else np.vstack([results[i].trace, r.trace]))
+    finally:
+        if executor:
+            executor.shutdown()
+
+    fun = np.array([r.fun if a and np.isfinite(r.fun) else np.inf for r, a in zip(results, active)])
+    best = results[int(np.argmin(fun))]
+
+    return best, results, active
+
+# Declare that an objective function accepts a stacked parameter matrix
+def vectorized(f):
+    """Marks `f` as vectorized: called with an (M, K) matrix of parameters 
+    (one set of parameters per row), it returns the M values of the 
+    objective function. The numerical derivatives then evaluate all 
+    perturbed parameters in one call of `f`.
+    """
+    f.vectorized = True
+    return f
+
+# Evaluate the objective function at each row of points
+def _evaluate(f,points,args=(),executor=None):
+    if getattr(f,'vectorized',False):
+        return np.asarray(f(points,*args),dtype=float)
+    if executor is not None:
+        return np.array(list(executor.map(partial(_call,f,args),points)),dtype=float)
+    return np.array([f(p,*args) for p in points],dtype=float)
+
+def _call(f,args,param):
+    return f(param,*args)
 
 # Numeric gradient fuction
-def _numgr(f,param,difftype='forward',eps=np.sqrt(np.finfo(float).eps),*args):    
+def _numgr(f,param,difftype='forward',eps=np.sqrt(np.finfo(float).eps),*args,executor=None):
     
     # Define scalars and initialize vectors
     K = len(param)                          # No. of parameters
-    gr = np.full(K,np.nan)                  # Initialize gradient vector
     ej = np.eye(K)*eps                      # Vector of eps
     
     # If difftype == 'central', then:
     if difftype == 'central':
-        for k in range(K):
-            gr[k] = (f(param + ej[:,k],*args) - f(param - ej[:,k],*args))*0.5/eps
+        fv = _evaluate(f,np.vstack((param + ej, param - ej)),args,executor)
+        gr = (fv[:K] - fv[K:])*0.5/eps
 
     # ...else, if difftype == 'forward' (default):
     elif difftype == 'forward':
-        f0 = f(param,*args)
-        for k in range(K):
-            gr[k] = (f(param + ej[:,k],*args) - f0)/eps
+        fv = _evaluate(f,np.vstack((param, param + ej)),args,executor)
+        gr = (fv[1:] - fv[0])/eps
 
     # ...else, return error
     else:
@@ -163,38 +644,211 @@ def _numgr(f,param,difftype='forward',eps=np.sqrt(np.finfo(float).eps),*args):
 
 # Numeric Hessian function
 class numhess:
-    
-    def __init__(self,f,eps=np.sqrt(np.finfo(float).eps)):
+    """Numerical Hessian with central differences.
+
+    Only the upper triangle is computed, and all perturbed parameters are 
+    evaluated at once, either in one call of a `vectorized` objective 
+    function or, if given, concurrently in `executor`.
+    """
+    def __init__(self,f,eps=np.sqrt(np.finfo(float).eps),executor=None):
         self.f = f
         self.eps = eps
+        self.executor = executor
     
     def __call__(self,param,*args):
         eps = self.eps
-        f = self.f
 
         # Define scalars and initialize vectors
         K = len(param)                          # No. of parameters
         hs = np.full((K,K),np.nan)              # Initialize Hessian vector
         ej = np.eye(K)*eps                      # Vector of eps
+        i, j = np.triu_indices(K,1)
 
-        # f0 = f(param,*args)
-        for i in range(K):
-            for j in range(K):
-                # f1 = f(param + ej[:,i] + ej[:,j],*args)
-                # f2 = f(param + ej[:,i],*args)
-                # f3 = f(param + ej[:,j],*args)
-
-                # hs[i,j] = (f1-f2-f3+f0)/(eps**2)
-                # if i != j:
-                #     hs[i,j] = (f1-f2-f3+f0)/(eps**2)
-                
-                f1 = f(param + ej[:,i] + ej[:,j],*args)
-                f2 = f(param + ej[:,i] - ej[:,j],*args)
-                f3 = f(param - ej[:,i] + ej[:,j],*args)
-                f4 = f(param - ej[:,i] - ej[:,j],*args)
-
-                hs[i,j] = (f1-f2-f3+f4)/(4*eps*eps)
-                if i != j:
-                    hs[j,i] = (f1-f2-f3+f4)/(4*eps*eps)
+        # Points of the off-diagonal elements (+/-, +/-), and of the diagonal elements, 
+        # where the mixed points of the central difference are all equal to param
+        points = np.vstack((param + ej[i] + ej[j], param + ej[i] - ej[j], param - ej[i] + ej[j], param - ej[i] - ej[j],
+                            param + 2*ej, param - 2*ej, param[np.newaxis,:]))
+        fv = _evaluate(self.f,points,args,self.executor)
+
+        M = len(i)
+        f1, f2, f3, f4 = fv[:M], fv[M:2*M], fv[2*M:3*M], fv[3*M:4*M]
+        hs[i,j] = hs[j,i] = (f1-f2-f3+f4)/(4*eps*eps)
+
+        fp, fm, f0 = fv[4*M:4*M+K], fv[4*M+K:4*M+2*K], fv[-1]
+        hs[np.arange(K),np.arange(K)] = (fp-2*f0+fm)/(4*eps*eps)
     
         return hs
+
+# Standard errors of the estimated parameters
+class StdErrors:
+    """Standard errors of maximum likelihood estimates.
+
+    The Hessian and the per-respondent scores of the negative log-likelihood 
+    function are only computed the first time they are needed, and are 
+    kept for later requests.
+
+    Parameters
+    ----------
+    x : numpy.ndarray
+        The estimated parameters.
+    hessian : callable, optional
+        Function that returns the Hessian of the negative log-likelihood 
+        function, evaluated at `x`.
+    scores : callable, optional
+        Function that returns an (N, K) array with the gradient of the 
+        negative log-likelihood contribution of each respondent, evaluated 
+        at `x`.
+    args : tuple, optional
+        Extra arguments passed to `hessian` and `scores`.
+    hessianArgs : tuple, optional
+        Extra arguments passed to `hessian`, if different from `args` 
+        (e.g. data compressed to unique rows with their counts).
+    weights : numpy.ndarray, optional
+        Number of respondents represented by each row of the scores.
+    clusters : numpy.ndarray, optional
+        Respondent index of each row of the scores. If given, the scores 
+        are summed per respondent before computing their outer product.
+    fixed : array_like, optional
+        Indices of parameters fixed to normalise the model. They are left 
+        out of the covariance matrix, and their standard errors are NaN.
+
+    Methods
+    -------
+    covariance(method):
+        Returns the covariance matrix of the estimated parameters.
+    __call__(method):
+        Returns the standard errors of the estimated parameters.
+    """
+    methods = ('hessian', 'opg', 'sandwich')
+
+    def __init__(self, x, hessian=None, scores=None, args=(), weights=None, clusters=None, fixed=None, hessianArgs=None):
+        self.x = x
+        self.hessian = hessian
+        self.scores = scores
+        self.args = args
+        self.hessianArgs = args if hessianArgs is None else hessianArgs
+        self.weights = weights
+        self.clusters = clusters
+        self.free = np.setdiff1d(np.arange(len(x)), [] if fixed is None else fixed)
+
+        self._hess = None
+        self._opg = None
+
+    def _get_hessian(self):
+        if self.hessian is None:
+            raise ValueError('The Hessian of the model is not available.')
+        if self._hess is None:
+            self._hess = self.hessian(self.x,*self.hessianArgs)[np.ix_(self.free,self.free)]
+        return self._hess
+
+    def _get_opg(self):
+        if self.scores is None:
+            raise ValueError('The scores of the model are not available.')
+        if self._opg is None:
+            s = self.scores(self.x,*self.args)[:,self.free]
+            if self.clusters is not None:
+                s = np.stack([np.bincount(self.clusters, weights=s[:,k]) for k in range(s.shape[1])], axis=1)
+            w = np.ones(s.shape[0]) if self.weights is None else self.weights
+            self._opg = (s * w[:,np.newaxis]).T @ s
+        return self._opg
+
+    def covariance(self, method='hessian'):
+        """Covariance matrix of the estimated parameters.
+
+        Parameters
+        ----------
+        method : str
+            `'hessian'` for the inverse of the Hessian, `'opg'` for the 
+            inverse of the outer product of the scores, or `'sandwich'` 
+            for the robust (sandwich) estimator.
+
+        Returns
+        -------
+        numpy.ndarray
+            The covariance matrix. Rows and columns of fixed parameters are 
+            NaN, and so is the whole matrix if the Hessian or the outer 
+            product of the scores is singular (i.e. some parameters are not 
+            identified).
+        """
+        if method == 'hessian':
+            cov = _inv(self._get_hessian())
+        elif method == 'opg':
+            cov = _inv(self._get_opg())
+        elif method == 'sandwich':
+            H_inv = _inv(self._get_hessian())
+            cov = H_inv @ self._get_opg() @ H_inv
+        else:
+            raise ValueError('''method must be either 'hessian', 'opg' or 'sandwich' ''')
+
+        # Put back the fixed parameters
+        K = len(self.x)
+        full = np.full((K,K), np.nan)
+        full[np.ix_(self.free,self.free)] = cov
+        return full
+
+    def __call__(self, method='hessian'):
+        with np.errstate(invalid='ignore'):
+            return np.sqrt(np.diag(self.covariance(method)))
+
+# Inverse of a symmetric matrix, or NaN if it is singular
+def _inv(a):
+    try:
+        return np.linalg.inv(a)
+    except np.linalg.LinAlgError:
+        return np.full(a.shape, np.nan)
+
+# Arrays shared with the worker processes of a process pool
+class _SharedArrays:
+    """Copies arrays into shared memory blocks, so worker processes can 
+    read them without pickling a copy per task.
+
+    Parameters
+    ----------
+    **arrays : numpy.ndarray
+        The arrays to share, by name.
+
+    Attributes
+    ----------
+    spec : dict
+        Name, shape and dtype of the shared memory block of each array. 
+        Pass it to the workers and read the arrays with `_attach_shared`.
+    """
+    def __init__(self, **arrays):
+        from multiprocessing import shared_memory
+
+        self._blocks = []
+        self.spec = {}
+        for key, a in arrays.items():
+            a = np.ascontiguousarray(a)
+            shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+            np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+            self._blocks.append(shm)
+            self.spec[key] = (shm.name, a.shape, a.dtype.str)
+
+    def close(self):
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Read-only views of the arrays shared by _SharedArrays
+def _attach_shared(spec):
+    from multiprocessing import shared_memory
+
+    arrays = {}
+    blocks = []
+    for key, (name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=name)
+        a = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        a.flags.writeable = False
+        arrays[key] = a
+        blocks.append(shm)
+
+    # The views are only valid while the blocks are open, so the caller keeps them referenced
+    return arrays, blocks
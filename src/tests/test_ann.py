@@ -5,14 +5,16 @@
 #  The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
 #
 #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import dataclasses
+import numpy as np
 import pandas as pd
 from pathlib import Path
 
 from py_np4vtt.data_format import Vars
-from py_np4vtt.model_ann import ModelANN, ConfigANN
+from py_np4vtt.model_ann import ModelANN, ConfigANN, _MLPPredictor
 from py_np4vtt.data_import import make_modelarrays, compute_descriptives
 
-from tests.test_helpers import check_in_range
+from tests.test_helpers import check_in_range, load_demo_arrays
 
 def run_test():
     # Step 1: read CSV file
@@ -62,5 +64,94 @@ def run_test():
         print('Rho-squared: PASS')
 
 
+def ann_arrays(NP=150):
+    # Model arrays of the first respondents of the demo data, to keep the ANN tests short
+    arrays = load_demo_arrays()
+    return dataclasses.replace(arrays, BVTT=arrays.BVTT[:NP], Choice=arrays.Choice[:NP], Accepts=arrays.Accepts[:NP], ID=arrays.ID[:NP], NP=NP, RowID=arrays.RowID[:NP])
+
+def test_shuffle_index():
+    NP, S, T = 50, 4, 9
+    index = ModelANN.shuffleIndex(np.random.default_rng(1234), NP, S, T)
+    assert index.shape == (NP, S, T+1)
+
+    # Each shuffle is a permutation of the tasks, followed by one of them
+    assert np.all(np.sort(index[:,:,:T], axis=2) == np.arange(T))
+    assert np.all(np.any(index[:,:,:T] == index[:,:,T:], axis=2))
+
+def test_chunk_size():
+    # The simulation of the choices in blocks of respondents does not change the results
+    arrays = ann_arrays()
+    results = ModelANN(ConfigANN([5], 2, 5, 1234, chunkSize=100), arrays).run(verbose=False)
+    results_chunked = ModelANN(ConfigANN([5], 2, 5, 1234, chunkSize=7), arrays).run(verbose=False)
+    for r, r_chunked in zip(results[:3], results_chunked[:3]):
+        assert np.array_equal(r, r_chunked)
+
+def test_parallel_repeats():
+    # Each repeat has its own seed, so the results do not depend on the number of workers
+    arrays = ann_arrays()
+    results = ModelANN(ConfigANN([5], 2, 5, 1234), arrays).run(verbose=False)
+    results_parallel = ModelANN(ConfigANN([5], 2, 5, 1234, n_jobs=2), arrays).run(verbose=False)
+    for r, r_parallel in zip(results[:3], results_parallel[:3]):
+        assert np.array_equal(r, r_parallel)
+
+def test_recover_vtt():
+    # Noisy decreasing choice probabilities, with some exactly at 0.5 and some that do not cross 0.5
+    rng = np.random.default_rng(1234)
+    NP, G = 200, 51
+    vtt_grid = np.tile(np.linspace(0, 25, G), (NP, 1))
+    y_pred = 1/(1 + np.exp(vtt_grid - rng.uniform(-5, 30, (NP, 1)))) + rng.normal(0, 0.02, (NP, G))
+    y_pred[:10, 20] = 0.5
+    y_pred[10:20] = np.clip(y_pred[10:20], 0.51, None)
+
+    # Per-respondent loop of earlier versions
+    VTT_loop = np.zeros(NP)
+    no_vtt = 0
+    for n in range(NP):
+        if np.max(y_pred[n,:]) > 0.5 and np.min(y_pred[n,:]) < 0.5:
+            hi = np.where((y_pred[n,:]-0.5) >= 0)[0][-1]
+            lo = np.where((y_pred[n,:]-0.5) <= 0)[0][0]
+            delta_x = vtt_grid[n,hi] - vtt_grid[n,lo]
+            delta_y = y_pred[n,hi] - y_pred[n,lo]
+            VTT_loop[n] = vtt_grid[n,hi] - (y_pred[n,hi]-0.5)/(delta_y/delta_x)
+        else:
+            no_vtt = no_vtt+1
+
+    VTT, unrecovered = ModelANN.recoverVTT(y_pred, vtt_grid)
+    assert np.sum(unrecovered) == no_vtt
+    assert np.allclose(VTT, VTT_loop)
+
+def test_bisect_vtt():
+    # The bisection finds the crossing of the grid search within the tolerance. Both use the same shuffles of the choices
+    model = ModelANN(ConfigANN([5], 1, 1, 1234), load_demo_arrays())
+    seed_ann, _ = ModelANN._repeatSeeds(np.random.SeedSequence(1234))
+    clf = model.trainANN([5], seed_ann)
+
+    arrays = ann_arrays(60)
+    vtt_grid = np.linspace(0, 1.5*model.X_full.max(), 1001)
+    y_pred = ModelANN.simulateNChoice(model, clf, arrays.Choice, np.tile(vtt_grid, (arrays.NP, 1)), arrays.BVTT, 20, rng=np.random.default_rng(5))
+    VTT_grid, unrecovered_grid = ModelANN.recoverVTT(y_pred, vtt_grid)
+    VTT, unrecovered = ModelANN.bisectVTT(model, clf, arrays.Choice, (vtt_grid[0], vtt_grid[-1]), arrays.BVTT, 20, tol=0.01, rng=np.random.default_rng(5))
+
+    assert np.array_equal(unrecovered, unrecovered_grid)
+    assert np.sum(~unrecovered) > arrays.NP/2
+    assert np.all(np.abs(VTT - VTT_grid) < 0.01)
+
+def test_mlp_predictor():
+    # The NumPy forward pass matches scikit-learn, on scaled inputs and with the scaling folded into the first layer
+    model = ModelANN(ConfigANN([5, 5], 1, 5, 1234), ann_arrays())
+    clf = model.trainANN([5, 5], np.random.SeedSequence(1234))
+    p = clf.predict_proba(model.X_train)
+    assert np.max(np.abs(_MLPPredictor(clf, blockSize=100).predict_proba(model.X_train) - p)) < 1e-6
+    assert np.max(np.abs(_MLPPredictor(clf, model.scaler, blockSize=100).predict_proba(model.scaler.inverse_transform(model.X_train)) - p)) < 1e-6
+
+def test_search_topology():
+    model = ModelANN(ConfigANN([5], 1, 5, 1234), ann_arrays())
+    table = model.searchTopology([[2], [5], [3, 3]], verbose=False)
+    assert list(table.columns) == ['hiddenLayerNodes', 'ce_test', 'ce_train', 'll', 'rho_sq', 'est_time']
+    assert sorted(map(tuple, table['hiddenLayerNodes'])) == [(2,), (3, 3), (5,)]
+
+    # Ranked from the lowest cross-entropy in the test sample
+    assert table['ce_test'].is_monotonic_increasing
+
 if __name__ == '__main__':
     run_test()
@@ -5,8 +5,37 @@
 #  The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
 #
 #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from py_np4vtt.data_format import Vars
+from py_np4vtt.data_import import make_modelarrays
 
 
 def check_in_range(expected: float, actual: float, margin_proportion: float):
     margin_absolute = abs(expected) * margin_proportion
     return (expected - margin_absolute) < actual < (expected + margin_absolute)
+
+def load_demo_arrays():
+    # Model arrays of the Norwegian demo data, in the units of the original file
+    columnarrays = {
+        Vars.Id: 'RespID',
+        Vars.ChosenAlt: 'Chosen',
+        Vars.Cost1: 'CostL',
+        Vars.Cost2: 'CostR',
+        Vars.Time1: 'TimeL',
+        Vars.Time2: 'TimeR',
+    }
+
+    reporoot_dir = Path(__file__).resolve().parent.parent.parent
+    df = pd.read_table(reporoot_dir / 'data' / 'Norway2009VTT_demodata.txt')
+
+    return make_modelarrays(df, columnarrays)
+
+def check_derivative(f, jac, x, args=(), eps=1e-6):
+    # Largest relative difference between `jac` and a central finite difference of `f`
+    x = np.asarray(x, dtype=float)
+    numeric = np.array([(f(x + eps*e, *args) - f(x - eps*e, *args))/(2*eps) for e in np.eye(len(x))]).T
+    analytic = jac(x, *args)
+    return np.max(np.abs(analytic - numeric))/max(1., np.max(np.abs(numeric)))
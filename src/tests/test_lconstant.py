@@ -6,12 +6,16 @@
 #
 #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 from pathlib import Path
+import numpy as np
 import pandas as pd
+import pytest
 
 from py_np4vtt.data_format import Vars
 from py_np4vtt.model_lconstant import ModelLConstant, ConfigLConstant
 from py_np4vtt.data_import import make_modelarrays, compute_descriptives
 
+from tests.test_helpers import load_demo_arrays
+
 def run_test():
     # Step 1: read CSV file
     columnarrays = {
@@ -42,5 +46,47 @@ def run_test():
 
     return vtt_grid, p
 
+def test_nadaraya_watson_binned():
+    # Same estimates as the estimator over all observations, also at evaluation points equal to a BVTT
+    arrays = load_demo_arrays()
+    Y, X = ~arrays.Choice.flatten(), arrays.BVTT.flatten()
+    X_u, n, Ysum = ModelLConstant.binned_statistics(Y, X)
+    x = np.sort(np.r_[np.linspace(1, 16, 31), X_u[(X_u > 1) & (X_u < 16)][::20]])
+    for h in (0.3, 2.):
+        assert np.allclose(ModelLConstant.nadaraya_watson_binned(x, X_u, n, Ysum, h), ModelLConstant.nadaraya_watson(x, Y, X, h))
+
+    # No observations at or below the evaluation point
+    with pytest.raises(ValueError):
+        ModelLConstant.nadaraya_watson_binned(np.array([X_u[0] - 1.]), X_u, n, Ysum, 0.3)
+
+def test_cross_validation(capsys):
+    # Leave-one-out criterion of the first respondents, against a brute-force loop over the observations
+    arrays = load_demo_arrays()
+    Y, X = ~arrays.Choice[:30].flatten(), arrays.BVTT[:30].flatten()
+    bandwidths = np.array([0.3, 1., 3.])
+
+    cv_loop = np.zeros(len(bandwidths))
+    n_obs = 0
+    for i in range(len(X)):
+        others = (X <= X[i]) & (np.arange(len(X)) != i)
+        if not others.any():
+            continue
+        n_obs = n_obs + 1
+        for b, h in enumerate(bandwidths):
+            K = np.exp(-0.5*((X[i] - X[others])/h)**2)
+            cv_loop[b] = cv_loop[b] + (Y[i] - K @ Y[others]/np.sum(K))**2
+    cv_loop = cv_loop/n_obs
+
+    h, _, cv = ModelLConstant.crossValidation(*ModelLConstant.binned_statistics(Y, X), bandwidths)
+    assert np.allclose(cv, cv_loop)
+    assert h == bandwidths[np.argmin(cv_loop)]
+
+    # The model selects the same kernel width, without printing if not verbose
+    arrays.BVTT, arrays.Choice, arrays.NP = arrays.BVTT[:30], arrays.Choice[:30], 30
+    model = ModelLConstant(ConfigLConstant(1, 16, 16, 'cv', bandwidths=bandwidths, verbose=False), arrays)
+    model.run()
+    assert model.kernelWidth == h
+    assert capsys.readouterr().out == ''
+
 if __name__ == '__main__':
     run_test()
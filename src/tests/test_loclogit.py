@@ -6,13 +6,16 @@
 #
 #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 from pathlib import Path
+import contextlib
+import io
+import numpy as np
 import pandas as pd
 
 from py_np4vtt.data_format import Vars
 from py_np4vtt.model_loclogit import ModelLocLogit, ConfigLocLogit
 from py_np4vtt.data_import import make_modelarrays, compute_descriptives
 
-from tests.test_helpers import check_in_range
+from tests.test_helpers import check_in_range, load_demo_arrays
 
 
 def run_test():
@@ -55,5 +58,35 @@ def run_test():
     return vtt_grid, p
 
 
+def run_loclogit(**kwargs):
+    # Local logit on the demo data, without the messages of the model
+    with contextlib.redirect_stdout(io.StringIO()):
+        return ModelLocLogit(ConfigLocLogit(0, 17, 18, **kwargs), load_demo_arrays()).run()
+
+def test_batched_newton():
+    # The batched Newton solver reaches the optimum of the BFGS fit of each support point
+    p, _, ll, _ = run_loclogit(optimizer='bfgs')
+    p_newton, _, ll_newton, _ = run_loclogit(optimizer='newton')
+    assert np.allclose(p_newton, p, atol=1e-4)
+    assert ll_newton > ll - 1e-3
+
+def test_kernel_window():
+    # The slice of the sorted BVTT holds the observations of the open window, also at grid points equal to a BVTT
+    arrays = load_demo_arrays()
+    BVTT_sorted = np.sort(arrays.BVTT.flatten())
+    x0 = np.r_[np.linspace(0, 17, 18), np.unique(BVTT_sorted)[::40]]
+    for k in (0.5, 1.):
+        lo, hi = ModelLocLogit.kernelWindow(BVTT_sorted, x0, k)
+        for n in range(len(x0)):
+            window = np.flatnonzero((BVTT_sorted > x0[n] - k) & (BVTT_sorted < x0[n] + k))
+            assert np.array_equal(np.arange(lo[n], hi[n]), window)
+
+def test_parallel_support_points():
+    # The support points are collected in order, so the results do not depend on the number of workers
+    p, _, ll, _ = run_loclogit()
+    p_parallel, _, ll_parallel, _ = run_loclogit(n_jobs=2)
+    assert np.array_equal(p_parallel, p)
+    assert ll_parallel == ll
+
 if __name__ == '__main__':
     run_test()
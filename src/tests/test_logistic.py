@@ -5,6 +5,7 @@
 #  The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
 #
 #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import numpy as np
 import pandas as pd
 from pathlib import Path
 
@@ -12,7 +13,7 @@ from py_np4vtt.data_format import Vars
 from py_np4vtt.model_logistic import ModelLogistic, ConfigLogistic
 from py_np4vtt.data_import import make_modelarrays, compute_descriptives
 
-from tests.test_helpers import check_in_range
+from tests.test_helpers import check_in_range, check_derivative, load_demo_arrays
 
 
 def run_test():
@@ -60,5 +61,68 @@ def run_test():
         print('Final F-value: PASS')
 
 
+def logistic_args():
+    # Arguments of the likelihood functions on the demo data, with the first choice of each respondent held out
+    arrays = load_demo_arrays()
+    BVTT = arrays.BVTT[:,0]
+    sumYBVTT = np.sum(arrays.BVTT[:,1:] * arrays.Choice[:,1:], axis=1)
+    y_regress = arrays.Choice[:,0].astype(int)
+    return np.array([0.15, 1., 0.3]), (sumYBVTT, BVTT, y_regress)
+
+def test_gradient():
+    x, args = logistic_args()
+    assert check_derivative(ModelLogistic.objectiveFunction, ModelLogistic.gradient, x, args) < 1e-6
+
+def test_hessian():
+    x, args = logistic_args()
+    assert check_derivative(ModelLogistic.gradient, ModelLogistic.hessian, x, args) < 1e-6
+
+def test_scores():
+    # Scores of the first respondents, against the negative log-likelihood of each respondent
+    x, args = logistic_args()
+    args = tuple(a[:20] for a in args)
+    contributions = lambda x, *args: np.array([ModelLogistic.objectiveFunction(x, *(a[[n]] for a in args)) for n in range(20)])
+    assert check_derivative(contributions, ModelLogistic.scores, x, args) < 1e-6
+
+def test_single_draw():
+    # With one random held-out choice, the estimates are those of earlier versions
+    model = ModelLogistic(ConfigLogistic(1, 0, 1, 10000, 12345, verbose=False), load_demo_arrays())
+    ll, exitflag = model.run()[4:6]
+    assert exitflag == 0
+    assert abs(ll - -2488.7747) < 1e-3
+
+def test_trust_exact():
+    # scipy's trust-exact reports the convergence at the optimum of BFGS, on five stacked draws with the BVTT in NOK per hour
+    arrays = load_demo_arrays()
+    arrays.BVTT = arrays.BVTT*60/9
+    ll, exitflag = ModelLogistic(ConfigLogistic(1, 0, 1, 10000, 1234, draws=5, verbose=False), arrays).run()[4:6]
+    ll_trust, exitflag_trust = ModelLogistic(ConfigLogistic(1, 0, 1, 10000, 1234, draws=5, optimizer='trust-exact', verbose=False), arrays).run()[4:6]
+    assert exitflag_trust == 0
+    assert abs(ll_trust - ll) < 1e-4
+
+def test_multistart():
+    arrays = load_demo_arrays()
+    ll = ModelLogistic(ConfigLogistic(1, 0, 1, 10000, 1234, verbose=False), arrays).run()[4]
+
+    # Dominated starts are abandoned after the first iterations, and the best start reaches the single-start optimum
+    model = ModelLogistic(ConfigLogistic(1, 0, 1, 10000, 1234, starts=8, startCutoff=5., verbose=False), arrays)
+    ll_multi = model.run()[4]
+    assert np.any(np.isnan(model.startLogLik))
+    assert np.sum(~np.isnan(model.startLogLik)) > 1
+    assert abs(ll_multi - ll) < 1e-6
+    assert ll_multi == np.nanmax(model.startLogLik)
+
+    # Starts run in parallel give the same results
+    model_parallel = ModelLogistic(ConfigLogistic(1, 0, 1, 10000, 1234, starts=8, startCutoff=5., n_jobs=2, verbose=False), arrays)
+    assert model_parallel.run()[4] == ll_multi
+    assert np.array_equal(model_parallel.startLogLik, model.startLogLik, equal_nan=True)
+
+def test_verbose(capsys):
+    # Nothing is printed without verbose, including the held-out choices and the starts
+    arrays = load_demo_arrays()
+    for optimizer in ('bfgs', 'trust-exact'):
+        ModelLogistic(ConfigLogistic(1, 0, 1, 10000, 1234, optimizer=optimizer, seMethod='sandwich', starts=2, verbose=False), arrays).run()
+    assert capsys.readouterr().out == ''
+
 if __name__ == '__main__':
     run_test()
@@ -5,6 +5,7 @@
 #  The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
 #
 #  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import numpy as np
 import pandas as pd
 from pathlib import Path
 
@@ -12,7 +13,7 @@ from py_np4vtt.data_format import Vars
 from py_np4vtt.model_rouwendal import ConfigRouwendal, ModelRouwendal
 from py_np4vtt.data_import import make_modelarrays, compute_descriptives
 
-from tests.test_helpers import check_in_range
+from tests.test_helpers import check_in_range, check_derivative, load_demo_arrays
 
 def run_test():
     # Step 1: read CSV file
@@ -65,5 +66,89 @@ def run_test():
         print('Q Prob: PASS')
 
 
+def rouwendal_args(supportPoints=21):
+    # Arguments of the likelihood functions on the demo data, and parameters away from the optimum
+    arrays = load_demo_arrays()
+    vtt_grid = np.linspace(0, 17, supportPoints)
+    tau, counts = np.unique(ModelRouwendal.consistentChoices(arrays.BVTT, arrays.Choice, vtt_grid), axis=0, return_counts=True)
+    x = np.r_[2., np.random.default_rng(1234).normal(size=supportPoints)]
+    return x, (arrays.T, tau, counts)
+
+def test_gradient():
+    x, args = rouwendal_args()
+    assert check_derivative(ModelRouwendal.objectiveFunction, ModelRouwendal.gradient, x, args) < 1e-6
+
+def test_hessian():
+    x, args = rouwendal_args()
+    assert check_derivative(ModelRouwendal.gradient, ModelRouwendal.hessian, x, args) < 1e-6
+
+def test_scores():
+    # Scores of the first response patterns, against the negative log-likelihood of each pattern
+    x, (T, tau, counts) = rouwendal_args()
+    tau = tau[:20]
+    contributions = lambda x, T, tau, counts: np.array([ModelRouwendal.objectiveFunction(x, T, tau[[n]], np.ones(1)) for n in range(len(tau))])
+    assert check_derivative(contributions, ModelRouwendal.scores, x, (T, tau, counts[:20])) < 1e-6
+
+def test_standard_errors():
+    # The density parameters are normalised at the point with the highest density, whose standard error is NaN
+    model = ModelRouwendal(ConfigRouwendal(0, 17, 18, 0.9, verbose=False), load_demo_arrays())
+    x, se = model.run()[3:5]
+    ref = np.argmax(x)
+    assert x[ref] == 0
+    assert np.isnan(se[ref])
+
+    # The other points with a non-negligible density have distinct, finite standard errors
+    free = (x > -5) & (x < 0)
+    assert np.all(np.isfinite(se[free]))
+    assert len(np.unique(se[free])) == np.sum(free)
+
+def test_large_density_parameters():
+    # The softmax of the density is shifted, so large parameters do not overflow
+    x, args = rouwendal_args()
+    x[1:] = 1000*x[1:]
+    assert np.isfinite(ModelRouwendal.objectiveFunction(x, *args))
+    assert np.all(np.isfinite(ModelRouwendal.gradient(x, *args)))
+    assert np.all(np.isfinite(ModelRouwendal.hessian(x, *args)))
+
+def test_trust_exact():
+    model = ModelRouwendal(ConfigRouwendal(0, 17, 18, 0.9, optimizer='trust-exact', seMethod='lazy', verbose=False), load_demo_arrays())
+    results = model.run()
+    ll, exitflag = results[8], results[9]
+    assert exitflag == 0
+    assert ll > -23335.7
+
+    # Newton's method is not available, as the Hessian is singular
+    assert ConfigRouwendal(0, 17, 18, 0.9, optimizer='newton').validate()
+
+def test_em():
+    # The EM algorithm and SQUAREM reach the optimum of BFGS
+    arrays = load_demo_arrays()
+    ll = ModelRouwendal(ConfigRouwendal(0, 17, 18, 0.9, seMethod='lazy', verbose=False), arrays).run()[8]
+    for optimizer, maxIterations in [('em', 5000), ('squarem', 1000)]:
+        model = ModelRouwendal(ConfigRouwendal(0, 17, 18, 0.9, optimizer=optimizer, maxIterations=maxIterations, seMethod='lazy', verbose=False), arrays)
+        results = model.run()
+        assert results[9] == 0
+        assert abs(results[8] - ll) < 1e-2
+
+    # SQUAREM falls back to plain EM steps, so the log-likelihood never decreases
+    assert model.results.iterations < 100
+    assert np.all(np.diff(model.results.trace[:,0]) <= 0)
+
+def test_verbose(capsys):
+    # Nothing is printed without verbose, including the collapsed patterns and the starts
+    arrays = load_demo_arrays()
+    for optimizer in ('bfgs', 'squarem', 'trust-exact'):
+        ModelRouwendal(ConfigRouwendal(0, 17, 18, 0.9, optimizer=optimizer, starts=2, seed=1, seMethod='lazy', verbose=False), arrays).run()
+    assert capsys.readouterr().out == ''
+
+def test_consistent_choices():
+    # Same counts as the tiled (T, NP, G) arrays of earlier versions, including grid points equal to a BVTT
+    arrays = load_demo_arrays()
+    vtt_grid = np.unique(np.r_[np.linspace(0, 17, 18), np.unique(arrays.BVTT)[::40]])
+    BVTT_array = np.tile(arrays.BVTT, (len(vtt_grid), 1, 1)).T
+    Choice_array = np.tile(arrays.Choice, (len(vtt_grid), 1, 1)).T
+    tau = ((vtt_grid > BVTT_array) == Choice_array).astype(int).sum(axis=0)
+    assert np.array_equal(ModelRouwendal.consistentChoices(arrays.BVTT, arrays.Choice, vtt_grid), tau)
+
 if __name__ == '__main__':
     run_test()
@@ -0,0 +1,89 @@
+#  Copyright 2021 Technische Universiteit Delft
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+import numpy as np
+import pandas as pd
+import pytest
+from pathlib import Path
+
+from py_np4vtt.data_format import Vars
+from py_np4vtt.model_rv import ConfigRV, ModelRV
+from py_np4vtt.data_import import make_modelarrays
+
+from tests.test_helpers import check_derivative, load_demo_arrays
+
+def rv_args():
+    # Unique (BVTT, choice) pairs of the demo data with their counts, and parameters away from the optimum
+    arrays = load_demo_arrays()
+    pairs, counts = np.unique(np.c_[arrays.BVTT.flatten(), arrays.Choice.flatten()], axis=0, return_counts=True)
+    return np.array([0.5, 5.]), (pairs[:,0], pairs[:,1], counts)
+
+def test_gradient():
+    x, args = rv_args()
+    assert check_derivative(ModelRV.objectiveFunction, ModelRV.gradient, x, args) < 1e-6
+
+def test_hessian():
+    x, args = rv_args()
+    assert check_derivative(ModelRV.gradient, ModelRV.hessian, x, args) < 1e-6
+
+def test_scores():
+    # Scores of the first pairs, against the negative log-likelihood of each pair
+    x, (BVTT, y_regress, _) = rv_args()
+    args = (BVTT[:20], y_regress[:20])
+    contributions = lambda x, BVTT, y_regress: np.array([ModelRV.objectiveFunction(x, BVTT[[n]], y_regress[[n]]) for n in range(20)])
+    assert check_derivative(contributions, ModelRV.scores, x, args) < 1e-6
+
+def test_unbalanced_clusters():
+    # Without some choice situations, the scores are still clustered by respondent
+    columnarrays = {
+        Vars.Id: 'RespID',
+        Vars.ChosenAlt: 'Chosen',
+        Vars.Cost1: 'CostL',
+        Vars.Cost2: 'CostR',
+        Vars.Time1: 'TimeL',
+        Vars.Time2: 'TimeR',
+    }
+
+    reporoot_dir = Path(__file__).resolve().parent.parent.parent
+    df = pd.read_table(reporoot_dir / 'data' / 'Norway2009VTT_demodata.txt')
+    model_arrays = make_modelarrays(df.drop(index=df.index[::7]), columnarrays)
+    assert not model_arrays.is_balanced_panel
+
+    model = ModelRV(ConfigRV(0, 1, 10000, seMethod='sandwich', verbose=False), model_arrays)
+    model.run()
+    assert len(np.unique(model.stdErrors.clusters)) == model_arrays.NP
+
+def test_undefined_bvtt():
+    # Choice situations with an undefined BVTT are not dropped silently
+    arrays = load_demo_arrays()
+    arrays.BVTT[3,2] = np.nan
+    with pytest.raises(ValueError):
+        ModelRV(ConfigRV(1, 5, 10000, verbose=False), arrays).run()
+
+def test_trust_exact():
+    # scipy's trust-exact reports the convergence at the optimum of BFGS
+    arrays = load_demo_arrays()
+    ll, exitflag = ModelRV(ConfigRV(1, 5, 10000, verbose=False), arrays).run()[3:5]
+    ll_trust, exitflag_trust = ModelRV(ConfigRV(1, 5, 10000, optimizer='trust-exact', verbose=False), arrays).run()[3:5]
+    assert exitflag_trust == 0
+    assert abs(ll_trust - ll) < 1e-4
+
+def test_verbose(capsys):
+    # Nothing is printed without verbose, including the starts
+    arrays = load_demo_arrays()
+    for optimizer in ('bfgs', 'trust-exact'):
+        ModelRV(ConfigRV(1, 5, 10000, optimizer=optimizer, starts=2, seed=1, verbose=False), arrays).run()
+    assert capsys.readouterr().out == ''
+
+if __name__ == '__main__':
+    test_gradient()
+    test_hessian()
+    test_scores()
+    test_unbalanced_clusters()
+    test_undefined_bvtt()
+    test_trust_exact()
+    print('Random valuation checks: PASS')
@@ -0,0 +1,100 @@
+#  Copyright 2021 Technische Universiteit Delft
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from py_np4vtt.utils import _bfgsmin, _numgr, minimize, numhess, vectorized
+from py_np4vtt.model_rouwendal import ConfigRouwendal, ModelRouwendal
+
+from tests.test_helpers import load_demo_arrays
+
+def rosenbrock(x):
+    return 100*(x[1] - x[0]**2)**2 + (1 - x[0])**2
+
+def rosenbrock_gradient(x):
+    return np.array([-400*x[0]*(x[1] - x[0]**2) - 2*(1 - x[0]), 200*(x[1] - x[0]**2)])
+
+def test_bfgs_rosenbrock():
+    x0 = np.array([-1.2, 1.])
+    for method in ('bfgs', 'lbfgs'):
+        results = minimize(rosenbrock, x0, method=method, jac=rosenbrock_gradient)
+        assert results.convergence == 0
+        assert np.allclose(results.x, 1., atol=1e-3)
+
+        # One row of the trace per iteration
+        assert results.trace.shape == (results.iterations, 3)
+
+def rosenbrock_hessian(x):
+    return np.array([[1200*x[0]**2 - 400*x[1] + 2, -400*x[0]], [-400*x[0], 200.]])
+
+def test_evaluation_counts():
+    # The counts match the calls of each routine, and the trace has one row per iteration ending at the optimum
+    for method in ('bfgs', 'lbfgs', 'newton', 'L-BFGS-B', 'trust-exact'):
+        calls = {'f': 0, 'g': 0, 'h': 0}
+        def f(x): calls['f'] += 1; return rosenbrock(x)
+        def jac(x): calls['g'] += 1; return rosenbrock_gradient(x)
+        def hess(x): calls['h'] += 1; return rosenbrock_hessian(x)
+
+        results = minimize(f, np.array([-1.2, 1.]), method=method, jac=jac, hess=hess)
+        assert results.convergence == 0
+        assert (results.nfev, results.njev, results.nhev) == (calls['f'], calls['g'], calls['h'])
+        assert results.trace.shape == (results.iterations, 3)
+        assert results.trace[-1,0] == results.fun
+        assert np.isclose(results.trace[-1,1], np.linalg.norm(rosenbrock_gradient(results.x)))
+
+def test_bfgs_no_iterations():
+    x0 = np.array([-1.2, 1.])
+    results = _bfgsmin(rosenbrock, x0, maxiter=0, jac=rosenbrock_gradient)
+    assert results['iterations'] == 0
+    assert results['convergence'] == 2
+    assert np.array_equal(results['x'], x0)
+
+def test_bfgs_rouwendal_fine_grid():
+    # With 300 grid points the first steepest descent step saturates the density if it is not scaled
+    model = ModelRouwendal(ConfigRouwendal(0, 30, 300, 0.9, seMethod='lazy', verbose=False), load_demo_arrays())
+    results = model.run()
+    ll, exitflag = results[8], results[9]
+    assert exitflag == 0
+    assert ll > -22496.6
+
+def smooth(x, a):
+    return np.sum(np.exp(a*x)) + np.prod(np.sin(x)) + x[0]**2*x[-1]
+
+@vectorized
+def smooth_vectorized(x, a):
+    return np.sum(np.exp(a*x), axis=-1) + np.prod(np.sin(x), axis=-1) + x[...,0]**2*x[...,-1]
+
+def test_numerical_derivatives():
+    # All perturbed parameters at once, in one call or in an executor, against a loop over the parameters
+    x, a = np.array([0.3, -0.2, 0.5, 0.1]), 0.7
+    K, eps = len(x), 1e-5
+    ej = np.eye(K)*eps
+    g_loop = np.array([(smooth(x + ej[k], a) - smooth(x - ej[k], a))*0.5/eps for k in range(K)])
+    g_forward = np.array([(smooth(x + ej[k], a) - smooth(x, a))/eps for k in range(K)])
+    h_loop = np.array([[(smooth(x + ej[i] + ej[j], a) - smooth(x + ej[i] - ej[j], a) - smooth(x - ej[i] + ej[j], a) + smooth(x - ej[i] - ej[j], a))/(4*eps*eps)
+                        for j in range(K)] for i in range(K)])
+
+    with ThreadPoolExecutor(2) as executor:
+        for f, ex in ((smooth, None), (smooth_vectorized, None), (smooth, executor)):
+            assert np.allclose(_numgr(f, x, 'central', eps, a, executor=ex), g_loop, rtol=0, atol=1e-9)
+            assert np.allclose(_numgr(f, x, 'forward', eps, a, executor=ex), g_forward, rtol=0, atol=1e-9)
+            assert np.allclose(numhess(f, eps, ex)(x, a), h_loop, rtol=0, atol=1e-4)
+
+        # The numerical gradient of minimize evaluates the same points in the executor
+        results = minimize(rosenbrock, np.array([-1.2, 1.]))
+        results_executor = minimize(rosenbrock, np.array([-1.2, 1.]), executor=executor)
+        assert np.array_equal(results_executor.x, results.x)
+        assert results_executor.nfev == results.nfev
+
+if __name__ == '__main__':
+    test_bfgs_rosenbrock()
+    test_evaluation_counts()
+    test_bfgs_no_iterations()
+    test_bfgs_rouwendal_fine_grid()
+    test_numerical_derivatives()
+    print('Optimiser checks: PASS')